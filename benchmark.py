@@ -0,0 +1,391 @@
+import argparse
+import contextlib
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+import engines
+from dataset import create_gaussian_probe
+from diffraction_stack import FULL_SCALE, DiffractionStack, DiffractionStackWriter
+from fft_backend import fft_backend_info
+from kernels import kernels_available
+from simulator import intensity_scale, simulate_scan
+from subpixel import split_positions
+from trajectory import fermat_spiral
+
+try:
+    import resource
+except ImportError:  # not available on Windows, peak RSS is then reported as null
+    resource = None
+
+# Benchmark cases (frame size, number of positions) of every preset
+PRESETS = {
+    "quick": [(64, 50), (128, 200)],
+    "default": [(64, 50), (128, 200), (256, 500), (512, 1000)],
+    "full": [
+        (64, 50),
+        (128, 200),
+        (256, 500),
+        (512, 1000),
+        (1024, 2000),
+        (2048, 5000),
+    ],
+}
+
+# Engines benchmarked, as (function of engines.py, fixed options)
+ENGINES = {
+    "pie": ("ptychographic_iterative_engine", {"mode": "sequential"}),
+    "pie-batched": ("ptychographic_iterative_engine", {"mode": "batched"}),
+    "pie-parallel": ("ptychographic_iterative_engine", {"mode": "parallel"}),
+    "pie-numba": ("ptychographic_iterative_engine", {"kernels": "numba"}),
+    "pie-single": ("ptychographic_iterative_engine", {"precision": "single"}),
+    "epie": ("ptychographic_iterative_engine", {"algorithm": "epie"}),
+    "rpie": ("ptychographic_iterative_engine", {"algorithm": "rpie"}),
+    "mpie": ("ptychographic_iterative_engine", {"algorithm": "mpie", "seed": 0}),
+    "raar": ("projection_engine", {"algorithm": "raar"}),
+    "dm": ("projection_engine", {"algorithm": "dm"}),
+    "ml-poisson": ("maximum_likelihood_engine", {"noise": "poisson"}),
+    "ml-gaussian": ("maximum_likelihood_engine", {"noise": "gaussian"}),
+    "tiled": ("tiled_engine", {"sync_every": 5}),
+    "multiresolution": ("multiresolution_engine", {}),
+}
+
+# Probe positions are about this many frame widths apart (the probe sigma)
+STEP_FRACTION = 1 / 8
+
+# Pixels illuminated by less than this fraction of the peak are left out of the error
+ILLUMINATION_THRESHOLD = 0.1
+
+
+def synthetic_object(shape, rng):
+    """
+    Smooth random complex object: magnitude in [0.5, 1] and a phase of about 1 rad rms.
+    :param shape: Shape (height, width) of the object.
+    :param rng: numpy random generator.
+    :return: Complex64 object field.
+    """
+    magnitude = cv2.GaussianBlur(rng.uniform(size=shape).astype(np.float32), (0, 0), 3)
+    magnitude = (magnitude - magnitude.min()) / np.ptp(magnitude)
+    phase = cv2.GaussianBlur(rng.normal(size=shape).astype(np.float32), (0, 0), 4)
+    phase /= phase.std()
+    return ((0.5 + 0.5 * magnitude) * np.exp(1j * phase)).astype(np.complex64)
+
+
+def write_dataset(
+    directory, frame_size, n_positions, seed=0, photons=None, chunk_frames=16
+):
+    """
+    Simulate a far-field scan of a synthetic object and write it to a directory:
+    the 16-bit frames and positions as a diffraction stack (stack.bin), the ground
+    truth object (object.npy) and the probe of the model (probe.npy). The frames
+    are simulated chunk by chunk, so only the object is held in memory.
+    :param directory: Output directory.
+    :param frame_size: Width and height of the frames in pixels.
+    :param n_positions: Number of probe positions (Fermat spiral).
+    :param seed: Seed of the object and of the noise.
+    :param photons: Photons per frame with Poisson noise, noiseless frames if None.
+    :param chunk_frames: Number of frames simulated (and read by the engines) together.
+    """
+    os.makedirs(directory, exist_ok=True)
+    shape = (frame_size, frame_size)
+    # beam of half the frame at the sample (unit pixels), sigma = frame_size / 8
+    probe = create_gaussian_probe(shape, frame_size / 2, 1.0, 1.0, 0).astype(
+        np.complex64
+    )
+
+    # spiral with one position per step^2 of area, shifted to the canvas origin
+    step = frame_size * STEP_FRACTION
+    positions_px = fermat_spiral(
+        n_positions, step * np.sqrt(n_positions / np.pi), shift=True
+    )
+    starts, _ = split_positions(positions_px)
+    object_field = synthetic_object(
+        tuple(starts.max(axis=0) + frame_size), np.random.default_rng(seed)
+    )
+
+    with DiffractionStackWriter(
+        os.path.join(directory, "stack.bin"), shape, positions_px, chunk_frames
+    ) as writer:
+        for frames in simulate_scan(
+            object_field,
+            probe,
+            positions_px,
+            1.0,
+            photons=photons,
+            chunk_frames=chunk_frames,
+            seed=seed,
+        ):
+            for frame in frames:
+                writer.write(frame)
+
+    # the stack holds sqrt(counts / FULL_SCALE), the model probe includes that scale
+    scale = intensity_scale(probe, photons) / FULL_SCALE
+    np.save(os.path.join(directory, "object.npy"), object_field)
+    np.save(os.path.join(directory, "probe.npy"), probe * np.sqrt(scale))
+
+
+def object_error(object_field, directory, positions_px, probe):
+    """
+    Relative error of a reconstruction against the ground truth of its dataset,
+    over the well illuminated pixels and after removing the global complex factor
+    that ptychography cannot recover.
+    :param object_field: Reconstructed object, with its origin at the first position.
+    :param directory: Dataset directory (see write_dataset).
+    :param positions_px: Probe positions of the dataset.
+    :param probe: Probe of the model.
+    :return: Error norm(c * object - truth) / norm(truth).
+    """
+    truth = np.load(os.path.join(directory, "object.npy"), mmap_mode="r")
+    shape = tuple(min(a, b) for a, b in zip(object_field.shape, truth.shape))
+    height, width = probe.shape
+
+    illumination = np.zeros(truth.shape, dtype=np.float32)
+    for y, x in split_positions(positions_px)[0].tolist():
+        illumination[y : y + height, x : x + width] += np.abs(probe) ** 2
+    illumination = illumination[: shape[0], : shape[1]]
+    mask = illumination > ILLUMINATION_THRESHOLD * illumination.max()
+
+    estimate = object_field[: shape[0], : shape[1]][mask].astype(np.complex128)
+    truth = truth[: shape[0], : shape[1]][mask].astype(np.complex128)
+    factor = np.vdot(estimate, truth) / max(np.vdot(estimate, estimate).real, 1e-30)
+    return float(np.linalg.norm(factor * estimate - truth) / np.linalg.norm(truth))
+
+
+def _peak_rss_mb(children=False):
+    """
+    Peak resident set size of this process, or of its largest child, in MB.
+    """
+    if resource is None:
+        return None
+    usage = resource.getrusage(
+        resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    )
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    unit = 1 if platform.system() == "Darwin" else 1024
+    return usage.ru_maxrss * unit / 2**20
+
+
+def _multiresolution_schedule(iterations):
+    """
+    Split the iterations of a multiresolution run: half at 1/4 of the resolution,
+    a quarter at 1/2 and the rest at full resolution.
+    """
+    schedule = ((4, iterations // 2), (2, iterations // 4))
+    schedule += ((1, iterations - sum(count for _, count in schedule)),)
+    return tuple((factor, count) for factor, count in schedule if count > 0)
+
+
+def _run_engine(directory, engine, iterations, connection):
+    """
+    Run an engine on a dataset and send its measurements through a pipe; meant
+    to run in a fresh process, so its peak RSS is the one of the engine alone.
+    """
+    name, options = ENGINES[engine]
+    options = dict(options)
+    if engine == "multiresolution":
+        options["schedule"] = _multiresolution_schedule(iterations)
+    else:
+        options["iterations"] = iterations
+
+    stack = DiffractionStack(os.path.join(directory, "stack.bin"))
+    probe = np.load(os.path.join(directory, "probe.npy"))
+    baseline = _peak_rss_mb()
+
+    # time at which every iteration was reported
+    times = []
+
+    def callback(progress):
+        times.append(time.perf_counter())
+
+    try:
+        start = time.perf_counter()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            object_field, _, errors = getattr(engines, name)(
+                None,
+                stack.positions_px,
+                1.0,
+                probe,
+                measured_amplitudes=stack,
+                callback=callback,
+                snapshot_every=iterations + 1,
+                **options,
+            )
+        seconds = time.perf_counter() - start
+    except Exception as error:
+        connection.send(
+            {"status": "failed", "reason": f"{type(error).__name__}: {error}"}
+        )
+        return
+
+    # steady-state cost: the first iteration also pays for the setup (and JIT);
+    # tiled runs report their iterations in bursts, once per synchronization
+    first = min(options.get("sync_every", 1), len(times)) - 1
+    connection.send(
+        {
+            "status": "ok",
+            "iterations": len(errors),
+            "seconds": seconds,
+            "first_iteration_seconds": times[first] - start,
+            "seconds_per_iteration": (
+                (times[-1] - times[first]) / (len(times) - 1 - first)
+                if len(times) - 1 > first
+                else seconds / len(times)
+            ),
+            "fourier_error": float(errors[-1]),
+            "object_error": object_error(
+                object_field, directory, stack.positions_px, probe
+            ),
+            "baseline_rss_mb": baseline,
+            "peak_rss_mb": _peak_rss_mb(),
+            "children_peak_rss_mb": _peak_rss_mb(children=True),
+        }
+    )
+
+
+def benchmark_engine(directory, engine, iterations):
+    """
+    Benchmark an engine on a dataset in a spawned process.
+    :param directory: Dataset directory (see write_dataset).
+    :param engine: Key of ENGINES.
+    :param iterations: Number of iterations.
+    :return: Dictionary of measurements, with status "ok", "skipped" or "failed".
+    """
+    if engine == "pie-numba" and not kernels_available("numba"):
+        return {"status": "skipped", "reason": "numba is not installed"}
+
+    context = multiprocessing.get_context("spawn")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(
+        target=_run_engine, args=(directory, engine, iterations, sender)
+    )
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = None
+    process.join()
+    if result is None or (process.exitcode and result["status"] == "ok"):
+        result = {"status": "failed", "reason": f"exit code {process.exitcode}"}
+    return result
+
+
+def environment():
+    """
+    Describe the machine and libraries of the run, to compare runs across releases.
+    """
+    return {
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "numpy": np.__version__,
+        "cpu_count": os.cpu_count(),
+        "fft": fft_backend_info(),
+        "numba": kernels_available("numba"),
+    }
+
+
+def run_benchmark(cases, engines, iterations=10, data_dir=None, seed=0, photons=None):
+    """
+    Benchmark every engine on every case.
+    :param cases: List of (frame size, number of positions).
+    :param engines: List of keys of ENGINES.
+    :param iterations: Number of iterations of every run.
+    :param data_dir: Directory keeping the datasets between runs; a temporary one
+        (removed afterwards) if None.
+    :param seed: Seed of the synthetic objects.
+    :param photons: Photons per frame with Poisson noise, noiseless frames if None.
+    :return: Report with the environment and one result per case and engine.
+    """
+    unknown = [engine for engine in engines if engine not in ENGINES]
+    if unknown:
+        raise ValueError(f"Unknown engines {unknown}, expected some of {list(ENGINES)}")
+
+    root = data_dir or tempfile.mkdtemp(prefix="ptycho-benchmark-")
+    results = []
+    try:
+        for frame_size, n_positions in cases:
+            noise = "noiseless" if photons is None else f"{photons:g}photons"
+            directory = os.path.join(root, f"{frame_size}x{n_positions}-{seed}-{noise}")
+            if not os.path.exists(os.path.join(directory, "probe.npy")):
+                print(f"Simulating {n_positions} frames of {frame_size}x{frame_size}")
+                write_dataset(directory, frame_size, n_positions, seed, photons)
+
+            for engine in engines:
+                result = benchmark_engine(directory, engine, iterations)
+                results.append(
+                    {
+                        "frame_size": frame_size,
+                        "positions": n_positions,
+                        "engine": engine,
+                        **result,
+                    }
+                )
+                print(
+                    f"{frame_size}x{n_positions} {engine}: {result['status']}"
+                    + (
+                        f", {result['seconds_per_iteration']:.4f} s/iteration, "
+                        f"error {result['object_error']:.4f}"
+                        if result["status"] == "ok"
+                        else f" ({result['reason']})"
+                    )
+                )
+    finally:
+        if data_dir is None:
+            shutil.rmtree(root, ignore_errors=True)
+
+    return {
+        "environment": environment(),
+        "iterations": iterations,
+        "seed": seed,
+        "photons": photons,
+        "results": results,
+    }
+
+
+def _parse_cases(text):
+    """
+    Parse "64x50,128x200" into [(64, 50), (128, 200)].
+    """
+    return [tuple(int(value) for value in case.split("x")) for case in text.split(",")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the reconstruction engines on synthetic datasets"
+    )
+    parser.add_argument("--preset", choices=PRESETS, default="quick")
+    parser.add_argument(
+        "--cases", type=_parse_cases, help="frame size x positions, e.g. 64x50,256x500"
+    )
+    parser.add_argument(
+        "--engines", default=",".join(ENGINES), help="comma-separated engines"
+    )
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--photons", type=float, help="photons per frame (Poisson noise)"
+    )
+    parser.add_argument("--data-dir", help="keep the simulated datasets here")
+    parser.add_argument("--output", default="benchmark.json")
+    args = parser.parse_args()
+
+    report = run_benchmark(
+        args.cases or PRESETS[args.preset],
+        args.engines.split(","),
+        args.iterations,
+        args.data_dir,
+        args.seed,
+        args.photons,
+    )
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"Results written to {args.output}")
@@ -18,6 +18,9 @@ class ScientificCamera(QThread):
     model_signal = Signal(str)
     written_signal = Signal(bool)
 
+    # Path of the last image written, read by the receivers of written_signal
+    last_image_path = None
+
     debug = 2
     stop = False
 
@@ -56,10 +59,10 @@ class ScientificCamera(QThread):
                         final_image = np.array(
                             np.mean(frames, axis=(0)), dtype=np.uint8
                         )
-                        written = cv2.imwrite(
-                            os.path.join(self.directory, "image_directory.png"),
-                            final_image,
+                        self.last_image_path = os.path.join(
+                            self.directory, "image_directory.png"
                         )
+                        written = cv2.imwrite(self.last_image_path, final_image)
 
                         self.written_signal.emit(written)
 
@@ -158,13 +161,11 @@ class ScientificCamera(QThread):
                                 )
 
                                 # NOTE: returns true if the image was successfully written
-                                written = cv2.imwrite(
-                                    os.path.join(
-                                        self.directory,
-                                        f"image_{imaging_index}.png",
-                                    ),
-                                    final_image,
+                                self.last_image_path = os.path.join(
+                                    self.directory,
+                                    f"image_{imaging_index}.png",
                                 )
+                                written = cv2.imwrite(self.last_image_path, final_image)
 
                                 # send signal for written and bind it to ptychography module
                                 self.written_signal.emit(written)
@@ -317,27 +318,19 @@ class ScientificCamera(QThread):
                         # take average of N frames
                         # NOTE: np.uint16 !!!
                         if index == self.n_frames:
+                            self.last_image_path = os.path.join(
+                                self.directory,
+                                f"image_{imaging_index}.png",
+                            )
                             if self.n_frames > 1:
                                 final_image = np.array(
                                     np.mean(frames, axis=(0)), dtype=np.uint16
                                 )
 
                                 # NOTE: returns true if the image was successfully written
-                                written = cv2.imwrite(
-                                    os.path.join(
-                                        self.directory,
-                                        f"image_{imaging_index}.png",
-                                    ),
-                                    final_image,
-                                )
+                                written = cv2.imwrite(self.last_image_path, final_image)
                             else:
-                                written = cv2.imwrite(
-                                    os.path.join(
-                                        self.directory,
-                                        f"image_{imaging_index}.png",
-                                    ),
-                                    frame,
-                                )
+                                written = cv2.imwrite(self.last_image_path, frame)
 
                             # send signal for written and bind it to ptychography module
                             self.written_signal.emit(written)
@@ -0,0 +1,90 @@
+import json
+import os
+import queue
+import threading
+
+import numpy as np
+
+
+def save_checkpoint(path, arrays, meta):
+    """
+    Write a checkpoint as a single .npz file, atomically (readers and resumed runs
+    never see a partial file).
+    :param path: Path of the checkpoint.
+    :param arrays: Dictionary of named arrays (object, probe, error history, ...).
+    :param meta: JSON-serializable state (iteration, RNG state, settings, ...).
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+
+    with open(temporary_path, "wb") as file:
+        np.savez(file, meta=np.array(json.dumps(meta)), **arrays)
+    os.replace(temporary_path, path)
+
+
+def load_checkpoint(path):
+    """
+    Read a checkpoint written by save_checkpoint.
+    :return: Dictionary of arrays and the meta dictionary.
+    """
+    with np.load(path) as checkpoint:
+        arrays = {name: checkpoint[name] for name in checkpoint.files if name != "meta"}
+        meta = json.loads(str(checkpoint["meta"]))
+    return arrays, meta
+
+
+class CheckpointWriter:
+    """
+    Save checkpoints on a background thread, so the engine only pays for copying
+    its state. At most one checkpoint waits behind the one being written.
+    A failed write is raised by the next save() or by close().
+    """
+
+    def __init__(self, path):
+        """
+        :param path: Path of the checkpoint, overwritten by every save.
+        """
+        self.path = path
+        self.error = None
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def save(self, arrays, meta):
+        """
+        Queue a checkpoint; the arrays must not be modified afterwards (pass copies).
+        """
+        self._raise_error()
+        self.queue.put((arrays, meta))
+
+    def _run(self):
+        while True:
+            checkpoint = self.queue.get()
+            if checkpoint is None:
+                break
+            # After a failure the queue is still drained, so save() never blocks
+            if self.error is None:
+                try:
+                    save_checkpoint(self.path, *checkpoint)
+                except Exception as error:
+                    self.error = error
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        """
+        Wait for the pending checkpoints to be written and stop the writer thread.
+        """
+        self.queue.put(None)
+        self.thread.join()
+        self._raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
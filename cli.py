@@ -0,0 +1,243 @@
+import argparse
+import contextlib
+import json
+import os
+
+import numpy as np
+
+from dataset import create_gaussian_probe, load_amplitudes
+from diffraction_stack import DiffractionStack
+from engines import (
+    maximum_likelihood_engine,
+    multiresolution_engine,
+    projection_engine,
+    ptychographic_iterative_engine,
+    tiled_engine,
+)
+from progress import SnapshotWriter
+
+# Engines selectable in a reconstruction config
+RECONSTRUCTION_ENGINES = {
+    "pie": ptychographic_iterative_engine,
+    "projection": projection_engine,
+    "ml": maximum_likelihood_engine,
+    "tiled": tiled_engine,
+    "multiresolution": multiresolution_engine,
+}
+
+# Default options of each engine, completed by the "options" of a config
+ENGINE_OPTIONS = {
+    "pie": {"beta": 0.9, "tolerance": 1e-3},
+    "projection": {"tolerance": 1e-3},
+    "ml": {"tolerance": 1e-3},
+    "tiled": {"beta": 0.9, "tolerance": 1e-3},
+    "multiresolution": {"beta": 0.9, "tolerance": 1e-3},
+}
+
+# Settings of a reconstruction, overridden by the keys of its config file
+RECONSTRUCT_DEFAULTS = {
+    "image_folder": "./images",  # Path to folder containing diffraction patterns
+    "positions_file": "./coordinates.csv",  # CSV file with probe positions
+    "image_indices": [2, 10],  # Image indices, as range(first, stop)
+    "pixel_size": 5.5,  # Sensor pixel size in micrometers
+    "wavelength": 0.739,  # Wavelength in micrometers
+    "probe_diameter": 150,  # Beam diameter in micrometers
+    "distance": 69540.0,  # Distance in micrometers
+    "engine": "pie",  # Key of RECONSTRUCTION_ENGINES
+    "iterations": 100,  # Number of iterations (schedule in options for multiresolution)
+    "options": {},  # Further arguments of the engine, over its ENGINE_OPTIONS
+    "cache_dir": "./cache",  # Folder of the preprocessed amplitude cache
+    "snapshot_dir": "./snapshots",  # Folder of the object snapshots, null to disable
+    "stack_file": None,  # On-disk diffraction stack, read instead of the images
+    "checkpoint": None,  # Checkpoint file ("pie" engine), null to disable
+    "resume": False,  # Continue from the checkpoint, which must exist
+    "output": "./reconstruction.npz",  # Object, probe and errors, null to skip
+    "figure": None,  # PNG of the object magnitude and phase, null to skip
+    "show": False,  # Display the object in a window at the end
+}
+
+# Settings of a stitching, overridden by the keys of its config file
+STITCH_DEFAULTS = {
+    "image_folder": "converted",  # Folder containing the diffraction images
+    "coordinates_csv": "coordinates.csv",  # CSV file with target-plane coordinates
+    "output_path": "converted_corrected_stitch.png",  # Stitched image
+    "canvas_width": 5000,
+    "canvas_height": 5000,
+}
+
+
+def load_config(path, defaults):
+    """
+    Read a JSON config file and complete it with the defaults.
+    :param path: Path of the config file.
+    :param defaults: Default settings; keys missing from them are rejected.
+    :return: Dictionary of settings.
+    """
+    with open(path) as file:
+        config = json.load(file)
+
+    unknown = sorted(set(config) - set(defaults))
+    if unknown:
+        raise ValueError(f"Unknown settings {unknown} in {path}")
+    return {**defaults, **config}
+
+
+def plot_object(object_field, path=None, show=False):
+    """
+    Plot the magnitude and phase of an object, saved to path and/or displayed.
+    matplotlib is only imported here, so the reconstruction never pays for it.
+    """
+    if show:
+        import matplotlib.pyplot as plt
+
+        figure = plt.figure(figsize=(12, 6))
+    else:
+        # Figure renders without pyplot, so no GUI backend is loaded
+        from matplotlib.figure import Figure
+
+        figure = Figure(figsize=(12, 6))
+
+    for position, (image, title) in enumerate(
+        [
+            (np.abs(object_field), "Reconstructed Object Magnitude"),
+            (np.angle(object_field), "Reconstructed Object Phase"),
+        ],
+        start=1,
+    ):
+        axes = figure.add_subplot(1, 2, position)
+        figure.colorbar(axes.imshow(image, cmap="gray"), ax=axes)
+        axes.set_title(title)
+
+    if path is not None:
+        figure.savefig(path)
+    if show:
+        plt.show()
+
+
+def reconstruct(config):
+    """
+    Run a reconstruction described by a config (see RECONSTRUCT_DEFAULTS).
+    :param config: Dictionary of settings.
+    :return: Reconstructed object, probe and errors.
+    """
+    engine = config["engine"]
+    if engine not in RECONSTRUCTION_ENGINES:
+        raise ValueError(
+            f"Unknown engine {engine!r}, expected one of {tuple(RECONSTRUCTION_ENGINES)}"
+        )
+
+    if config["stack_file"] is not None:
+        # Out-of-core: frames are read from the memory-mapped stack per position/batch
+        measured_amplitudes = DiffractionStack(config["stack_file"])
+        positions_px = measured_amplitudes.positions_px
+    else:
+        # Load data (decoded and preprocessed only on the first run)
+        measured_amplitudes, positions_px = load_amplitudes(
+            config["image_folder"],
+            config["positions_file"],
+            range(*config["image_indices"]),
+            config["pixel_size"],
+            cache_dir=config["cache_dir"],
+        )
+
+    probe = create_gaussian_probe(
+        measured_amplitudes.shape[1:],
+        config["probe_diameter"],
+        config["wavelength"],
+        config["pixel_size"],
+        config["distance"],
+    )
+
+    options = {**ENGINE_OPTIONS[engine], **config["options"]}
+    if engine != "multiresolution":
+        options["iterations"] = config["iterations"]
+    checkpoint = config["checkpoint"]
+    if checkpoint is not None:
+        if engine != "pie":
+            raise ValueError(f"Checkpoints are not supported by the {engine} engine")
+        options["checkpoint"] = checkpoint
+    if config["resume"]:
+        # Resuming is explicit: a missing checkpoint is an error, not a fresh start
+        if checkpoint is None or not os.path.exists(checkpoint):
+            raise FileNotFoundError(f"No checkpoint {checkpoint!r} to resume from")
+        options["resume"] = checkpoint
+
+    # Snapshots are saved in the background instead of blocking on plots
+    with contextlib.ExitStack() as stack:
+        if config["snapshot_dir"] is not None:
+            options["callback"] = stack.enter_context(
+                SnapshotWriter(config["snapshot_dir"])
+            )
+        object_field, probe, errors = RECONSTRUCTION_ENGINES[engine](
+            None,
+            positions_px,
+            config["pixel_size"],
+            probe,
+            measured_amplitudes=measured_amplitudes,
+            **options,
+        )
+
+    if config["output"] is not None:
+        np.savez(config["output"], object=object_field, probe=probe, errors=errors)
+        print(f"Reconstruction saved to {config['output']}")
+    if config["figure"] is not None or config["show"]:
+        plot_object(object_field, config["figure"], config["show"])
+
+    return object_field, probe, errors
+
+
+def stitch(config):
+    """
+    Stitch the images of a scan as described by a config (see STITCH_DEFAULTS).
+    """
+    # pandas (read by the stitching only) is not imported by reconstructions
+    from stitching import stitch_images
+
+    stitch_images(
+        config["image_folder"],
+        config["coordinates_csv"],
+        config["output_path"],
+        config["canvas_width"],
+        config["canvas_height"],
+    )
+
+
+def main(argv=None):
+    """
+    Command line: python cli.py {reconstruct,stitch} config.json, with --resume
+    to continue a reconstruction from its checkpoint
+    """
+    parser = argparse.ArgumentParser(
+        description="Ptychographic reconstruction and stitching of acquired scans"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    for name, help_text in (
+        ("reconstruct", "reconstruct the object of a scan"),
+        ("stitch", "stitch the diffraction images of a scan"),
+    ):
+        command = commands.add_parser(name, help=help_text)
+        command.add_argument(
+            "config", nargs="?", help="JSON settings file, defaults if omitted"
+        )
+        if name == "reconstruct":
+            command.add_argument(
+                "--resume",
+                action="store_true",
+                help="continue from the checkpoint file of the settings",
+            )
+    args = parser.parse_args(argv)
+
+    if args.command == "reconstruct":
+        defaults, run = RECONSTRUCT_DEFAULTS, reconstruct
+    else:
+        defaults, run = STITCH_DEFAULTS, stitch
+    config = (
+        dict(defaults) if args.config is None else load_config(args.config, defaults)
+    )
+    if getattr(args, "resume", False):
+        config["resume"] = True
+    run(config)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from preprocessing import (
+    dataset_key,
+    load_cached_amplitudes,
+    prepare_amplitudes,
+    save_cached_amplitudes,
+)
+
+
+# Create a Gaussian probe
+def create_gaussian_probe(shape, beam_diameter, wavelength, pixel_size, distance):
+    """
+    Create a Gaussian probe field based on beam parameters.
+    :param shape: Shape of the computational grid (image dimensions).
+    :param beam_diameter: Beam diameter at the target plane (in micrometers).
+    :param wavelength: Wavelength of the beam (in micrometers).
+    :param pixel_size: Size of each sensor pixel (in micrometers).
+    :param distance: Distance from the target to the sensor plane (in micrometers).
+    :return: Gaussian probe field (2D array).
+    """
+    beam_waist = beam_diameter / 2.0  # Beam waist (radius)
+    k = 2 * np.pi / wavelength  # Wavenumber
+    z_R = np.pi * beam_waist**2 / wavelength  # Rayleigh range
+
+    # Spot size at the sensor plane
+    spot_size_at_sensor = beam_waist * np.sqrt(1 + (distance / z_R) ** 2)
+
+    # Create a spatial grid
+    y = np.arange(-shape[0] // 2, shape[0] // 2) * pixel_size
+    x = np.arange(-shape[1] // 2, shape[1] // 2) * pixel_size
+    X, Y = np.meshgrid(x, y)
+
+    # Gaussian intensity profile
+    probe = np.exp(-(X**2 + Y**2) / (2 * (spot_size_at_sensor / 2.0) ** 2))
+    return probe
+
+
+# Load probe positions
+def load_positions(positions_file, pixel_size):
+    """
+    Load probe positions and convert them from micrometers to pixel indices.
+    :param positions_file: Path to CSV file with probe positions in micrometers.
+    :param pixel_size: Sensor pixel size in micrometers.
+    :return: Array of positions (in pixels).
+    """
+    # Load positions from CSV file (in micrometers), as written by the acquisition
+    positions_um = np.loadtxt(positions_file, delimiter=",", ndmin=2)
+
+    # Convert positions to pixel indices
+    return positions_um / pixel_size
+
+
+# Decode a single diffraction pattern
+def read_pattern(image_path):
+    """
+    Read a 16-bit diffraction image and normalize it to [0, 1].
+    :param image_path: Path of the image.
+    :return: Diffraction pattern (float32).
+    """
+    image = cv2.imread(image_path, cv2.IMREAD_UNCHANGED)
+    if image is None:
+        raise FileNotFoundError(f"Unable to read image {image_path}")
+    image = image.astype(np.float32)
+    image /= 65535.0  # Normalize 16-bit images to [0, 1]
+    return image
+
+
+def _decode_patterns(image_paths, workers):
+    """
+    Decode images on a thread pool (cv2.imread releases the GIL), yielding them in order.
+    At most 2 * workers images are decoded ahead of the consumer.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for image_path in image_paths:
+            pending.append(executor.submit(read_pattern, image_path))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+# Load diffraction patterns and positions
+def load_data(
+    image_folder, positions_file, image_indices, pixel_size, workers=None, stream=False
+):
+    """
+    Load diffraction patterns and convert positions from micrometers to pixel indices.
+    :param image_folder: Path to folder containing diffraction images.
+    :param positions_file: Path to CSV file with probe positions in micrometers.
+    :param image_indices: List of indices for the images.
+    :param pixel_size: Sensor pixel size in micrometers.
+    :param workers: Number of decoding threads, all available cores if None.
+    :param stream: Return a generator yielding the patterns as they are decoded
+        (in the order of image_indices) instead of a list.
+    :return: List (or generator) of diffraction patterns, array of positions (in pixels).
+    """
+    positions_px = load_positions(positions_file, pixel_size)
+
+    # Load images
+    image_paths = [f"{image_folder}/image_{i}.png" for i in image_indices]
+    patterns = _decode_patterns(image_paths, workers or os.cpu_count() or 1)
+
+    if not stream:
+        patterns = list(patterns)
+
+    return patterns, positions_px
+
+
+# Load measured amplitudes, preprocessed once and cached per dataset
+def load_amplitudes(
+    image_folder,
+    positions_file,
+    image_indices,
+    pixel_size,
+    frame_shape=None,
+    cache_dir="./cache",
+):
+    """
+    Load the measured amplitudes as a contiguous float32 stack, reusing the cache
+    of a previous run on the same images and settings.
+    :param image_folder: Path to folder containing diffraction images.
+    :param positions_file: Path to CSV file with probe positions in micrometers.
+    :param image_indices: List of indices for the images.
+    :param pixel_size: Sensor pixel size in micrometers.
+    :param frame_shape: Shape the amplitudes are resized to (probe shape), native if None.
+    :param cache_dir: Folder of the amplitude cache, None to disable caching.
+    :return: Amplitude stack (N, height, width), array of positions (in pixels).
+    """
+    positions_px = load_positions(positions_file, pixel_size)
+
+    image_paths = [f"{image_folder}/image_{i}.png" for i in image_indices]
+
+    if cache_dir is None:
+        patterns, _ = load_data(
+            image_folder, positions_file, image_indices, pixel_size, stream=True
+        )
+        amplitudes = prepare_amplitudes(patterns, frame_shape, len(image_paths))
+        return amplitudes, positions_px
+
+    settings = {
+        "frame_shape": None if frame_shape is None else list(frame_shape),
+        "normalization": 65535.0,
+    }
+    key = dataset_key(image_paths, settings)
+
+    amplitudes = load_cached_amplitudes(cache_dir, key)
+    if amplitudes is None:
+        # Frames are preprocessed while the next ones are still being decoded
+        patterns, _ = load_data(
+            image_folder, positions_file, image_indices, pixel_size, stream=True
+        )
+        amplitudes = prepare_amplitudes(patterns, frame_shape, len(image_paths))
+        save_cached_amplitudes(cache_dir, key, amplitudes)
+    else:
+        print(f"Loaded cached amplitudes {key[:12]}")
+
+    return amplitudes, positions_px
@@ -0,0 +1,187 @@
+import json
+import struct
+
+import cv2
+import numpy as np
+
+# File signature and layout of a diffraction stack:
+# MAGIC | header length (uint64) | JSON header | padding | uint16 frames (N, H, W)
+MAGIC = b"PTYSTACK"
+HEADER_ALIGNMENT = 4096
+
+# Full scale of the 16-bit frames
+FULL_SCALE = 65535.0
+
+
+class DiffractionStack:
+    """
+    Memory-mapped on-disk stack of 16-bit diffraction frames with their positions.
+    Indexing returns measured amplitudes (float32) read lazily from disk, so the
+    stack can stand in for the amplitude array of the reconstruction engine.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: Path of the stack file (see DiffractionStackWriter).
+        """
+        with open(path, "rb") as file:
+            if file.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a diffraction stack")
+            (header_length,) = struct.unpack("<Q", file.read(8))
+            header = json.loads(file.read(header_length))
+
+        self.path = path
+        self.chunk_frames = header["chunk_frames"]
+        self.positions_px = np.array(header["positions_px"], dtype=np.float64)
+        self.frames = np.memmap(
+            path,
+            dtype=np.uint16,
+            mode="r",
+            offset=header["data_offset"],
+            shape=(header["n_frames"], *header["frame_shape"]),
+        )
+
+    @property
+    def shape(self):
+        return self.frames.shape
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, index):
+        """
+        Measured amplitude of a position (int) or of a batch (slice or index array).
+        """
+        return np.sqrt(self.frames[index] / np.float32(FULL_SCALE), dtype=np.float32)
+
+    def __iter__(self):
+        """
+        Iterate over the amplitudes of every position, reading one chunk at a time.
+        """
+        for first in range(0, len(self), self.chunk_frames):
+            yield from self[first : first + self.chunk_frames]
+
+    def iter_chunks(self):
+        """
+        Iterate over (slice, amplitude chunk) pairs covering the whole stack.
+        """
+        for first in range(0, len(self), self.chunk_frames):
+            chunk = slice(first, min(first + self.chunk_frames, len(self)))
+            yield chunk, self[chunk]
+
+
+class DiffractionStackWriter:
+    """
+    Write diffraction frames one by one into a stack file, without keeping them in memory.
+    """
+
+    def __init__(self, path, frame_shape, positions_px, chunk_frames=16):
+        """
+        :param path: Path of the stack file.
+        :param frame_shape: Shape (height, width) of every frame.
+        :param positions_px: Array (N, 2) of probe positions in pixels, one per frame.
+        :param chunk_frames: Number of frames read together by the engine.
+        """
+        self.path = path
+        self.n_frames = len(positions_px)
+        self.frame_shape = tuple(frame_shape)
+        self.written = 0
+
+        header = {
+            "n_frames": self.n_frames,
+            "frame_shape": list(self.frame_shape),
+            "chunk_frames": chunk_frames,
+            "positions_px": np.asarray(positions_px, dtype=np.float64).tolist(),
+        }
+        # the data offset is part of the header, so size it with a placeholder first
+        header["data_offset"] = 0
+        header_length = len(json.dumps(header)) + 32
+        data_offset = -(-(len(MAGIC) + 8 + header_length) // HEADER_ALIGNMENT)
+        header["data_offset"] = data_offset * HEADER_ALIGNMENT
+        encoded = json.dumps(header).encode().ljust(header_length)
+
+        self.file = open(path, "wb")
+        self.file.write(MAGIC + struct.pack("<Q", header_length) + encoded)
+        self.file.seek(header["data_offset"])
+
+    def write(self, frame):
+        """
+        Append a frame; floating-point frames are taken as normalized to [0, 1].
+        """
+        if frame.shape != self.frame_shape:
+            raise ValueError(
+                f"Frame shape {frame.shape} does not match the stack {self.frame_shape}"
+            )
+        if self.written == self.n_frames:
+            raise ValueError("All the frames of the stack have already been written")
+
+        if np.issubdtype(frame.dtype, np.floating):
+            frame = np.clip(np.rint(frame * FULL_SCALE), 0, FULL_SCALE)
+        self.file.write(np.ascontiguousarray(frame, dtype="<u2").tobytes())
+        self.written += 1
+
+    def close(self):
+        self.file.close()
+        if self.written != self.n_frames:
+            raise ValueError(
+                f"Stack {self.path} has {self.written} of {self.n_frames} frames"
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+
+
+def read_frame(image_path):
+    """
+    Read a 16-bit diffraction image as raw counts (unlike dataset.read_pattern,
+    which normalizes it).
+    :param image_path: Path of the image.
+    :return: Frame (uint16).
+    """
+    image = cv2.imread(image_path, cv2.IMREAD_UNCHANGED)
+    if image is None:
+        raise FileNotFoundError(f"Unable to read image {image_path}")
+    return image
+
+
+def write_stack(path, image_folder, image_indices, positions_px, chunk_frames=16):
+    """
+    Convert a folder of 16-bit PNG frames (as read by load_data) into a stack file.
+    :param path: Path of the stack file.
+    :param image_folder: Path to folder containing diffraction images.
+    :param image_indices: List of indices for the images.
+    :param positions_px: Array of probe positions in pixels.
+    :param chunk_frames: Number of frames read together by the engine.
+    :return: The opened DiffractionStack.
+    """
+    image_indices = list(image_indices)
+    first = read_frame(f"{image_folder}/image_{image_indices[0]}.png")
+
+    with DiffractionStackWriter(
+        path, first.shape, positions_px[: len(image_indices)], chunk_frames
+    ) as writer:
+        writer.write(first)
+        for i in image_indices[1:]:
+            writer.write(read_frame(f"{image_folder}/image_{i}.png"))
+
+    return DiffractionStack(path)
+
+
+def mean_intensity(measured_amplitudes, chunk_frames=64):
+    """
+    Mean measured intensity, accumulated chunk by chunk so the stack is never loaded whole.
+    :param measured_amplitudes: Amplitude stack (array or DiffractionStack).
+    :param chunk_frames: Number of frames per chunk.
+    :return: Mean intensity (float32, frame shape).
+    """
+    total = np.zeros(measured_amplitudes.shape[1:], dtype=np.float64)
+    for first in range(0, len(measured_amplitudes), chunk_frames):
+        chunk = measured_amplitudes[first : first + chunk_frames]
+        total += np.sum(np.square(chunk, dtype=np.float64), axis=0)
+    return (total / len(measured_amplitudes)).astype(np.float32)
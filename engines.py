@@ -0,0 +1,1872 @@
+import multiprocessing
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import cv2
+import numpy as np
+
+from checkpoint import CheckpointWriter, load_checkpoint
+from dataset import read_pattern
+from diffraction_stack import mean_intensity
+from fft_backend import (
+    fft2c,
+    fft_backend_info,
+    fourier_resample,
+    ifft2c,
+    set_thread_fft_workers,
+)
+from kernels import KERNELS, FusedUpdate
+from preprocessing import crop_amplitudes, prepare_amplitudes
+from progress import make_progress
+from scheduling import colour_positions
+from subpixel import ShiftedProbes, split_positions
+from tiling import SharedArray, partition_tiles, tile_slices
+
+# Engine modes accepted by ptychographic_iterative_engine
+ENGINE_MODES = ("sequential", "batched", "parallel")
+
+# Update rules accepted by ptychographic_iterative_engine
+ALGORITHMS = ("pie", "epie", "rpie", "mpie")
+
+# Update rules of the engines that keep the probe fixed (tiled, online)
+FIXED_PROBE_ALGORITHMS = ("pie", "epie", "rpie")
+
+# Parallel projection algorithms accepted by projection_engine
+PROJECTION_ALGORITHMS = ("raar", "dm")
+
+# Noise models accepted by maximum_likelihood_engine
+NOISE_MODELS = ("poisson", "gaussian")
+
+# Maximum number of halvings/doublings of the maximum-likelihood line search
+LINE_SEARCH_STEPS = 30
+
+# Trial steps of the maximum-likelihood line search evaluated per pass over the data
+LINE_SEARCH_WINDOW = 4
+
+# Real and complex dtypes of each engine precision
+PRECISIONS = {
+    "single": (np.float32, np.complex64),
+    "double": (np.float64, np.complex128),
+}
+
+
+def _engine_amplitudes(diffraction_patterns, measured_amplitudes, probe_shape, dtype):
+    """
+    Amplitude stack and mean measured intensity of an engine.
+    :param diffraction_patterns: List of measured diffraction patterns, used if
+        measured_amplitudes is None.
+    :param measured_amplitudes: Preprocessed amplitude stack or DiffractionStack.
+    :param probe_shape: Shape of the probe field.
+    :param dtype: Real dtype of the engine precision.
+    :return: Amplitudes and mean measured intensity.
+    """
+    if measured_amplitudes is None:
+        # Amplitudes are computed (and resized to the probe) once, not per position
+        measured_amplitudes = prepare_amplitudes(diffraction_patterns, probe_shape)
+
+    # Amplitudes are never wider than the engine precision (data are 16-bit)
+    if isinstance(measured_amplitudes, np.ndarray):
+        if np.result_type(measured_amplitudes.dtype, dtype) != dtype:
+            measured_amplitudes = measured_amplitudes.astype(dtype)
+
+    if measured_amplitudes.shape[1:] != probe_shape:
+        raise ValueError(
+            f"Amplitudes of shape {measured_amplitudes.shape[1:]} do not match "
+            f"the probe {probe_shape}"
+        )
+
+    return measured_amplitudes, mean_intensity(measured_amplitudes)
+
+
+def _scan_canvas(positions_px, probe_shape):
+    """
+    Size the object canvas from the scan: the pixel extent of the positions plus
+    the probe footprint, so every ROI fits and no pixel lies outside the scan.
+    :param positions_px: Array of probe positions (x, y) in pixels.
+    :param probe_shape: Shape of the probe field.
+    :return: ROI origins (N, 2) as (y_start, x_start) on the canvas (the first
+        row and column hold a position), sub-pixel shifts (N, 2) and canvas shape.
+    """
+    starts, shifts = split_positions(positions_px)
+    starts -= starts.min(axis=0)
+    return starts, shifts, tuple((starts.max(axis=0) + probe_shape).tolist())
+
+
+def _flat_object(shape, probe, intensity, dtype):
+    """
+    Flat object whose predicted energy matches the measured one (Parseval).
+    :param shape: Shape of the object canvas.
+    :param probe: Probe field.
+    :param intensity: Measured intensity of a frame (mean pattern or total).
+    :param dtype: Complex dtype of the object.
+    """
+    probe_energy = np.sum(np.abs(probe) ** 2) * probe.size
+    return np.full(shape, np.sqrt(np.sum(intensity) / probe_energy), dtype=dtype)
+
+
+def _fit_canvas(field, shape):
+    """
+    Crop a field or extend it at its bottom/right edges to the given shape.
+    """
+    field = field[: shape[0], : shape[1]]
+    padding = [(0, size - current) for size, current in zip(shape, field.shape)]
+    return np.pad(field, padding, mode="edge")
+
+
+def _roi_slices(starts, probe_shape):
+    """
+    Precompute the object slices of every probe position.
+    :param starts: ROI origins (N, 2) as (y_start, x_start).
+    :param probe_shape: Shape of the probe field.
+    :return: List of (row slice, column slice), one per position.
+    """
+    height, width = probe_shape
+    return [
+        (slice(y_start, y_start + height), slice(x_start, x_start + width))
+        for y_start, x_start in starts.tolist()
+    ]
+
+
+def _check_precision(array, dtype, name):
+    """
+    Raise if an array was silently cast away from the precision of the engine.
+    """
+    if array.dtype != dtype:
+        raise TypeError(f"{name} has dtype {array.dtype}, expected {np.dtype(dtype)}")
+
+
+def _feedback_weight(probe, beta):
+    """
+    PIE feedback weight of a probe (or stack of probes).
+    """
+    return beta * probe.conj() / (np.abs(probe) ** 2 + 1e-8)
+
+
+def _regularized_weight(field, alpha, step):
+    """
+    rPIE feedback weight step * conj(F) / ((1 - alpha) |F|^2 + alpha max|F|^2) of a
+    field (or stack of fields, each normalized by its own maximum); alpha = 1 gives
+    the ePIE weight.
+    """
+    intensity = np.abs(field) ** 2
+    maximum = np.max(intensity, axis=(-2, -1), keepdims=True)
+    return step * field.conj() / ((1 - alpha) * intensity + alpha * maximum + 1e-12)
+
+
+def _update_position(
+    object_field, probe, object_weight, amplitude, roi, probe_weight=None
+):
+    """
+    Apply the PIE update of a single probe position to the object field (in place).
+    :param object_field: Complex object field.
+    :param probe: Probe field.
+    :param object_weight: Object feedback weight computed from the probe
+        (e.g. beta * conj(probe) / (|probe|^2 + eps)).
+    :param amplitude: Measured amplitude of the position (probe shape).
+    :param roi: Object slices of the position, as returned by _roi_slices.
+    :param probe_weight: Function giving the probe feedback weight from the object
+        ROI; when given, the probe is refined in place with the same residual.
+    :return: Fourier magnitude error sum((|predicted| - measured)^2) of the position.
+    """
+    # Get the corresponding region of the object (a view, always probe-sized)
+    object_roi = object_field[roi]
+
+    # Compute the exit wave (object * probe)
+    exit_wave = object_roi * probe
+
+    # Fourier transform of the exit wave
+    predicted_pattern = fft2c(exit_wave)
+    error = np.sum((np.abs(predicted_pattern) - amplitude) ** 2)
+
+    # Enforce the measured intensity while preserving the phase
+    updated_pattern = amplitude * np.exp(1j * np.angle(predicted_pattern))
+
+    # Inverse Fourier transform to get the updated exit wave
+    updated_exit_wave = ifft2c(updated_pattern, overwrite_input=True)
+
+    _check_precision(updated_exit_wave, object_field.dtype, "Updated exit wave")
+
+    # Exit-wave residual, shared by the object and probe updates
+    residual = updated_exit_wave
+    residual -= exit_wave
+
+    # The probe correction uses the object before its update
+    if probe_weight is not None:
+        probe_correction = probe_weight(object_roi) * residual
+
+    # Update object field with PIE feedback rule
+    residual *= object_weight
+    object_roi += residual
+
+    if probe_weight is not None:
+        probe += probe_correction
+
+    return error
+
+
+def _update_batch(
+    object_field, probes, object_weights, amplitudes, starts, probe_weight=None
+):
+    """
+    Apply the PIE update of a batch of probe positions at once (in place).
+    All exit waves are computed from the same object estimate and transformed as a
+    single 3D stack; the object corrections are then accumulated within the
+    bounding box of the batch and averaged where positions of the same batch overlap.
+    :param object_field: Complex object field.
+    :param probes: Probe field, or stack (B, height, width) of shifted probes.
+    :param object_weights: Object feedback weights computed from the probes,
+        shaped like probes.
+    :param amplitudes: Stack (B, height, width) of measured amplitudes of the batch.
+    :param starts: Array (B, 2) of ROI origins (y_start, x_start).
+    :param probe_weight: Function giving the probe feedback weight from the object
+        ROIs; when given, the (single) probe is refined in place with the average
+        correction of the batch.
+    :return: Fourier magnitude error sum((|predicted| - measured)^2) of the batch.
+    """
+    height, width = probes.shape[-2:]
+
+    # Gather the object ROIs of the batch, shape (B, height, width)
+    object_rois = np.stack(
+        [object_field[y : y + height, x : x + width] for y, x in starts.tolist()]
+    )
+    exit_waves = object_rois * probes
+
+    # Batched Fourier transform of the exit waves
+    predicted_patterns = fft2c(exit_waves)
+    magnitudes = np.abs(predicted_patterns)
+    error = np.sum((magnitudes - amplitudes) ** 2)
+
+    # Enforce the measured amplitudes while preserving the phase (a rescaling,
+    # much cheaper than exp(1j * angle); vanishing predictions get phase 0)
+    vanishing = magnitudes == 0
+    predicted_patterns[vanishing] = 1
+    magnitudes[vanishing] = 1
+    predicted_patterns *= amplitudes / magnitudes
+
+    # Batched inverse Fourier transform to get the updated exit waves
+    residuals = ifft2c(predicted_patterns, overwrite_input=True)
+
+    # Exit-wave residuals, shared by the object and probe updates
+    residuals -= exit_waves
+
+    # The probe correction uses the object before its update
+    if probe_weight is not None:
+        probe_correction = np.mean(probe_weight(object_rois) * residuals, axis=0)
+
+    # PIE feedback of every position of the batch
+    corrections = object_weights * residuals
+    _check_precision(corrections, object_field.dtype, "Object correction")
+
+    # Accumulate only inside the bounding box of the batch, one ROI window at a time
+    y_min, x_min = starts.min(axis=0)
+    y_max, x_max = starts.max(axis=0) + (height, width)
+    accumulated = np.zeros((y_max - y_min, x_max - x_min), dtype=corrections.dtype)
+    overlaps = np.zeros(accumulated.shape, dtype=amplitudes.dtype)
+    for (y, x), correction in zip((starts - (y_min, x_min)).tolist(), corrections):
+        accumulated[y : y + height, x : x + width] += correction
+        overlaps[y : y + height, x : x + width] += 1
+
+    # Average the corrections where ROIs of the same batch overlap
+    np.maximum(overlaps, 1, out=overlaps)
+    accumulated /= overlaps
+    object_field[y_min:y_max, x_min:x_max] += accumulated
+
+    if probe_weight is not None:
+        probes += probe_correction
+
+    return error
+
+
+# State of the current thread of a "parallel" mode pool (see _init_pool_thread)
+_pool_thread = threading.local()
+
+
+def _init_pool_thread(probe_shape, dtype, kernels):
+    """
+    Initializer of the threads of a "parallel" mode pool: the threads already
+    share the cores, so each one runs single-threaded FFTs and, with numba
+    kernels, its own single-threaded FusedUpdate and buffer.
+    """
+    set_thread_fft_workers(1)
+    _pool_thread.fused_update = (
+        FusedUpdate(probe_shape, dtype, parallel=False) if kernels == "numba" else None
+    )
+
+
+def _update_set(
+    executor,
+    workers,
+    object_field,
+    probe,
+    shifted_probes,
+    object_weight,
+    measured_amplitudes,
+    rois,
+    positions,
+    starts,
+    probe_weight=None,
+):
+    """
+    Apply the PIE updates of an independent set of positions concurrently (in place).
+    The ROIs of the set are disjoint, so every thread writes to its own part of
+    the object. The probe is held fixed during the set; when it is refined, the
+    corrections of the set are averaged, as in "batched" mode.
+    :param executor: Thread pool running the updates.
+    :param workers: Number of chunks the set is split into.
+    :param object_field: Complex object field.
+    :param probe: Probe field.
+    :param shifted_probes: ShiftedProbes of the sub-pixel positions, with their
+        object weights, or None.
+    :param object_weight: Function giving the object feedback weight of the probe.
+    :param measured_amplitudes: Amplitude stack (array or DiffractionStack).
+    :param rois: Object slices of every position.
+    :param positions: Indices of the positions of the set.
+    :param starts: ROI origins (N, 2) of every position, for the fused kernels of
+        the pool threads (used while the probe is fixed).
+    :param probe_weight: Function giving the probe feedback weight from the object
+        ROI, None to keep the probe fixed.
+    :return: Fourier magnitude error of the set.
+    """
+    weight = object_weight(probe) if shifted_probes is None else None
+
+    def update(chunk):
+        error = 0.0
+        correction = None if probe_weight is None else np.zeros_like(probe)
+        fused_update = None if probe_weight is not None else _pool_thread.fused_update
+        for idx in chunk.tolist():
+            if shifted_probes is None:
+                current_probe, current_weight = probe, weight
+            else:
+                current_probe, current_weight = shifted_probes.with_weights(idx)
+            if fused_update is not None:
+                error += fused_update(
+                    object_field,
+                    current_probe,
+                    current_weight,
+                    measured_amplitudes[idx],
+                    starts[idx],
+                )
+                continue
+            # _update_position refines the probe it is given, so give it a copy
+            if probe_weight is not None:
+                current_probe = current_probe.copy()
+            error += _update_position(
+                object_field,
+                current_probe,
+                current_weight,
+                measured_amplitudes[idx],
+                rois[idx],
+                probe_weight,
+            )
+            if probe_weight is not None:
+                correction += current_probe - probe
+        return error, correction
+
+    chunks = np.array_split(positions, min(workers, len(positions)))
+    results = list(executor.map(update, chunks))
+
+    # The probe is only changed once every thread of the set is done with it
+    if probe_weight is not None:
+        probe += sum(correction for _, correction in results) / len(positions)
+    return sum(error for error, _ in results)
+
+
+def _momentum_step(field, previous, velocity, eta):
+    """
+    mPIE momentum step (in place): accumulate the change of the field since the
+    previous step into the velocity and push the field further along it.
+    :param field: Object or probe field, updated in place.
+    :param previous: Field at the previous momentum step, updated in place.
+    :param velocity: Momentum of the field, updated in place.
+    :param eta: Momentum (friction) factor.
+    """
+    velocity *= eta
+    velocity += field - previous
+    field += eta * velocity
+    previous[...] = field
+
+
+def _converged(errors, tolerance, patience):
+    """
+    Stopping rule: the error improved by less than tolerance (relative) over the
+    last patience iterations.
+    :param errors: Error history, one value per iteration.
+    :param tolerance: Relative improvement below which the reconstruction stops.
+    :param patience: Number of iterations the improvement is measured over
+        (1 compares consecutive iterations, larger values detect a plateau).
+    """
+    if tolerance is None or len(errors) <= patience:
+        return False
+    reference = errors[-1 - patience]
+    return (reference - errors[-1]) < tolerance * reference
+
+
+def ptychographic_iterative_engine(
+    diffraction_patterns,
+    positions_px,
+    pixel_size,
+    probe,
+    iterations=100,
+    beta=0.9,
+    mode="sequential",
+    batch_size=16,
+    workers=None,
+    measured_amplitudes=None,
+    subpixel=False,
+    shift_cache="kernels",
+    precision="double",
+    tolerance=None,
+    patience=5,
+    callback=None,
+    snapshot_every=10,
+    snapshot_downsample=1,
+    algorithm="pie",
+    alpha=0.1,
+    probe_update_start=5,
+    probe_alpha=1.0,
+    probe_beta=1.0,
+    shuffle=None,
+    seed=None,
+    momentum=0.7,
+    probe_momentum=0.9,
+    momentum_period=None,
+    object_guess=None,
+    checkpoint=None,
+    checkpoint_every=10,
+    resume=None,
+    kernels="numpy",
+):
+    """
+    Perform phase retrieval using the Ptychographic Iterative Engine (PIE).
+    The object is reconstructed on the canvas spanned by the scan (the extent of
+    the positions plus the probe), with its origin at the first row and column
+    of positions.
+    :param diffraction_patterns: List of measured diffraction patterns.
+    :param positions_px: Array of probe positions in pixels (converted from micrometers).
+    :param pixel_size: Size of each pixel in micrometers.
+    :param probe: Initial probe field (Gaussian).
+    :param iterations: Number of iterations for PIE.
+    :param beta: Feedback parameter for object update.
+    :param mode: "sequential" updates one position at a time, "batched" stacks
+        batch_size exit waves and updates them together with batched FFTs,
+        "parallel" colours the overlap graph of the positions and updates the
+        positions of each independent set concurrently (same result as a
+        sequential sweep in colour order, up to the probe refinement).
+    :param batch_size: Number of positions per batch in "batched" mode.
+    :param workers: Number of threads in "parallel" mode, os.cpu_count() if None;
+        each thread uses single-threaded FFTs (and kernels).
+    :param measured_amplitudes: Preprocessed amplitude stack (see load_amplitudes),
+        or a DiffractionStack read lazily from disk; if given, diffraction_patterns
+        may be None.
+    :param subpixel: Place the probe at the exact (sub-pixel) positions by Fourier
+        shifting it, instead of rounding the positions to whole pixels.
+    :param shift_cache: "kernels" caches every shifted probe and its object weight
+        (fastest), "ramps" only the separable 1D phase ramps (least memory, one
+        extra IFFT per position).
+    :param precision: "double" (complex128/float64) or "single" (complex64/float32);
+        the object, probe, amplitudes and FFT buffers all stay in this precision.
+    :param tolerance: Stop early once the error improves by less than this fraction
+        over the last patience iterations; None always runs all iterations.
+    :param patience: Window (in iterations) of the early stopping rule.
+    :param callback: Called after every iteration with a progress.Progress report
+        (e.g. a progress.SnapshotWriter, or queue.put to hand reports to another
+        thread); it must not block.
+    :param snapshot_every: Attach an object snapshot to the report every this many
+        iterations (and on the last one).
+    :param snapshot_downsample: Downsampling factor of the snapshots.
+    :param algorithm: "pie" updates the object only; "epie" and "rpie" refine the
+        probe as well, with the (regularized) ePIE/rPIE feedback weights; "mpie"
+        is rPIE with momentum and randomized position order.
+    :param alpha: rPIE regularization of the object update (0 behaves like PIE,
+        1 like ePIE).
+    :param probe_update_start: Iteration from which the probe is refined
+        ("epie"/"rpie"); None keeps the probe fixed.
+    :param probe_alpha: rPIE regularization of the probe update.
+    :param probe_beta: Feedback parameter of the probe update.
+    :param shuffle: Visit the positions in a new random order every iteration;
+        None shuffles for "mpie" only.
+    :param seed: Seed of the random generator of the visiting order.
+    :param momentum: mPIE momentum of the object.
+    :param probe_momentum: mPIE momentum of the probe (while it is refined).
+    :param momentum_period: Number of position updates between momentum steps,
+        once per iteration if None.
+    :param object_guess: Initial object on the canvas (e.g. the upsampled result
+        of a coarser run), cropped or edge-extended at its bottom/right to the
+        canvas; None starts from a flat object matching the measured energy.
+    :param checkpoint: Path of a checkpoint file, rewritten every checkpoint_every
+        iterations (and at the end) by a background thread; None disables it.
+    :param checkpoint_every: Number of iterations between checkpoints.
+    :param resume: Path of a checkpoint to continue from, with the same data and
+        settings (a different algorithm, mode, precision or canvas is rejected);
+        the run then ends at the same state as an uninterrupted one of the given
+        number of iterations.
+    :param kernels: "numpy", or "numba" for the compiled, allocation-free
+        position update ("sequential" and "parallel" modes, with even frames;
+        iterations that refine the probe use the numpy update).
+    :return: Reconstructed object, probe and the normalized Fourier magnitude error
+        of every iteration that was run.
+    """
+    if mode not in ENGINE_MODES:
+        raise ValueError(
+            f"Unknown engine mode {mode!r}, expected one of {ENGINE_MODES}"
+        )
+    if batch_size < 1:
+        raise ValueError("batch_size must be a positive integer")
+    if precision not in PRECISIONS:
+        raise ValueError(
+            f"Unknown precision {precision!r}, expected one of {tuple(PRECISIONS)}"
+        )
+    if algorithm not in ALGORITHMS:
+        raise ValueError(
+            f"Unknown algorithm {algorithm!r}, expected one of {ALGORITHMS}"
+        )
+    if kernels not in KERNELS:
+        raise ValueError(f"Unknown kernels {kernels!r}, expected one of {KERNELS}")
+    if kernels != "numpy" and mode == "batched":
+        raise ValueError(f"{kernels} kernels are not supported in batched mode")
+    refine_probe = algorithm != "pie" and probe_update_start is not None
+    if refine_probe and subpixel:
+        raise ValueError("Probe refinement is not supported with subpixel=True")
+
+    real_dtype, complex_dtype = PRECISIONS[precision]
+    # copy, so the caller's probe is never refined in place
+    probe = np.array(probe, dtype=complex_dtype)
+
+    measured_amplitudes, measured_intensity = _engine_amplitudes(
+        diffraction_patterns, measured_amplitudes, probe.shape, real_dtype
+    )
+
+    # ROI origins and slices do not change between iterations
+    starts, shifts, canvas_shape = _scan_canvas(
+        positions_px[: len(measured_amplitudes)], probe.shape
+    )
+    rois = _roi_slices(starts, probe.shape)
+
+    if object_guess is None:
+        object_field = _flat_object(
+            canvas_shape, probe, measured_intensity, complex_dtype
+        )
+    else:
+        object_field = _fit_canvas(object_guess, canvas_shape).astype(complex_dtype)
+
+    # Object and probe feedback weights of the chosen update rule
+    if algorithm == "pie":
+        object_weight = partial(_feedback_weight, beta=beta)
+    else:
+        object_alpha = 1.0 if algorithm == "epie" else alpha
+        object_weight = partial(_regularized_weight, alpha=object_alpha, step=beta)
+    probe_weight = partial(_regularized_weight, alpha=probe_alpha, step=probe_beta)
+
+    # Probes translated by the sub-pixel remainder of each position, with their
+    # object weights (the probe is fixed with subpixel=True)
+    shifted_probes = (
+        ShiftedProbes(probe, shifts, shift_cache, object_weight) if subpixel else None
+    )
+
+    _check_precision(object_weight(probe), complex_dtype, "Object feedback weight")
+    if shifted_probes is not None:
+        _check_precision(shifted_probes[0], complex_dtype, "Shifted probe")
+
+    # Compiled update with its preallocated buffer; the threads of "parallel" mode
+    # have their own, and this one checks the kernels before the pool starts
+    fused_update = (
+        FusedUpdate(probe.shape, complex_dtype) if kernels == "numba" else None
+    )
+
+    # Visiting order and mPIE momentum state
+    rng = np.random.default_rng(seed)
+    if shuffle is None:
+        shuffle = algorithm == "mpie"
+    if momentum_period is None:
+        momentum_period = len(rois)
+    if algorithm == "mpie":
+        previous_object, object_velocity = object_field.copy(), np.zeros_like(
+            object_field
+        )
+        previous_probe, probe_velocity = probe.copy(), np.zeros_like(probe)
+    updates = 0
+
+    # Independent sets of non-overlapping positions, updated concurrently
+    if mode == "parallel":
+        colour_sets = colour_positions(starts, probe.shape)
+        workers = workers or os.cpu_count() or 1
+        executor = ThreadPoolExecutor(
+            max_workers=workers,
+            initializer=_init_pool_thread,
+            initargs=(probe.shape, complex_dtype, kernels),
+        )
+
+    # Measured energy, normalizing the Fourier magnitude error
+    total_intensity = float(np.sum(measured_intensity, dtype=np.float64)) * len(rois)
+    errors = []
+
+    # State that has to be saved for a resumed run to continue identically
+    state = {"object": object_field, "probe": probe}
+    if algorithm == "mpie":
+        state.update(
+            previous_object=previous_object,
+            object_velocity=object_velocity,
+            previous_probe=previous_probe,
+            probe_velocity=probe_velocity,
+        )
+
+    first_iteration = 0
+    if resume is not None:
+        arrays, meta = load_checkpoint(resume)
+        # A checkpoint only continues the run it was written by
+        settings = {"algorithm": algorithm, "mode": mode, "precision": precision}
+        for name, value in settings.items():
+            if meta.get(name) != value:
+                raise ValueError(
+                    f"Checkpoint {resume} was written with {name} "
+                    f"{meta.get(name)!r}, this run uses {value!r}"
+                )
+        missing = sorted(set(state) - set(arrays))
+        if missing:
+            raise ValueError(f"Checkpoint {resume} lacks the arrays {missing}")
+        for name, array in state.items():
+            if arrays[name].shape != array.shape:
+                raise ValueError(
+                    f"Checkpoint {name} of shape {arrays[name].shape} does not "
+                    f"match the {name} of this run {array.shape}"
+                )
+        for name, array in state.items():
+            array[...] = arrays[name]
+        errors = arrays["errors"].tolist()
+        first_iteration, updates = meta["iteration"], meta["updates"]
+        rng.bit_generator.state = meta["rng_state"]
+        print(f"Resuming from {resume} at iteration {first_iteration}")
+
+    checkpoint_writer = CheckpointWriter(checkpoint) if checkpoint else None
+
+    backend = fft_backend_info()
+    print(f"FFT backend: {backend['backend']} ({backend['workers']} workers)")
+
+    for it in range(first_iteration, iterations):
+        error = 0.0
+
+        # The probe is refined from probe_update_start on, so its weight changes per update
+        refining = refine_probe and it >= probe_update_start
+        probe_update = probe_weight if refining else None
+        weight = object_weight(probe)
+
+        order = rng.permutation(len(rois)) if shuffle else np.arange(len(rois))
+
+        if mode == "sequential":
+            for idx in order:
+                amplitude = measured_amplitudes[idx]
+                if shifted_probes is not None:
+                    current_probe, weight = shifted_probes.with_weights(idx)
+                else:
+                    current_probe = probe
+                    if refining:
+                        weight = object_weight(probe)
+                if fused_update is not None and not refining:
+                    error += fused_update(
+                        object_field, current_probe, weight, amplitude, starts[idx]
+                    )
+                else:
+                    error += _update_position(
+                        object_field,
+                        current_probe,
+                        weight,
+                        amplitude,
+                        rois[idx],
+                        probe_update,
+                    )
+                updates += 1
+                if algorithm == "mpie" and updates % momentum_period == 0:
+                    _momentum_step(
+                        object_field, previous_object, object_velocity, momentum
+                    )
+                    if refining:
+                        _momentum_step(
+                            probe, previous_probe, probe_velocity, probe_momentum
+                        )
+        elif mode == "batched":
+            for first in range(0, len(rois), batch_size):
+                batch = order[first : first + batch_size]
+                if shifted_probes is not None:
+                    probes, weight = shifted_probes.with_weights(batch)
+                else:
+                    probes = probe
+                    if refining:
+                        weight = object_weight(probe)
+                error += _update_batch(
+                    object_field,
+                    probes,
+                    weight,
+                    measured_amplitudes[batch],
+                    starts[batch],
+                    probe_update,
+                )
+                # momentum steps happen once the period is crossed within the batch
+                crossed = (updates + len(batch)) // momentum_period > (
+                    updates // momentum_period
+                )
+                updates += len(batch)
+                if algorithm == "mpie" and crossed:
+                    _momentum_step(
+                        object_field, previous_object, object_velocity, momentum
+                    )
+                    if refining:
+                        _momentum_step(
+                            probe, previous_probe, probe_velocity, probe_momentum
+                        )
+        else:
+            colour_order = rng.permutation(len(colour_sets)) if shuffle else None
+            for colour in (
+                range(len(colour_sets)) if colour_order is None else colour_order
+            ):
+                positions = colour_sets[colour]
+                error += _update_set(
+                    executor,
+                    workers,
+                    object_field,
+                    probe,
+                    shifted_probes,
+                    object_weight,
+                    measured_amplitudes,
+                    rois,
+                    positions,
+                    starts,
+                    probe_update,
+                )
+                crossed = (updates + len(positions)) // momentum_period > (
+                    updates // momentum_period
+                )
+                updates += len(positions)
+                if algorithm == "mpie" and crossed:
+                    _momentum_step(
+                        object_field, previous_object, object_velocity, momentum
+                    )
+                    if refining:
+                        _momentum_step(
+                            probe, previous_probe, probe_velocity, probe_momentum
+                        )
+
+        errors.append(error / total_intensity)
+        print(f"Iteration #{it}, error {errors[-1]:.4e}")
+
+        converged = _converged(errors, tolerance, patience)
+
+        # Report progress, with an intermediate snapshot every snapshot_every iterations
+        if callback is not None:
+            snapshot = it % snapshot_every == 0 or converged or it == iterations - 1
+            callback(
+                make_progress(
+                    it,
+                    errors[-1],
+                    object_field if snapshot else None,
+                    snapshot_downsample,
+                )
+            )
+
+        # Checkpoint copies of the state, written while the next iterations run
+        if checkpoint_writer is not None and (
+            (it + 1) % checkpoint_every == 0 or converged or it == iterations - 1
+        ):
+            checkpoint_writer.save(
+                {
+                    **{name: array.copy() for name, array in state.items()},
+                    "errors": np.array(errors),
+                },
+                {
+                    "iteration": it + 1,
+                    "updates": updates,
+                    "rng_state": rng.bit_generator.state,
+                    "algorithm": algorithm,
+                    "mode": mode,
+                    "precision": precision,
+                },
+            )
+
+        if converged:
+            print(f"Stopping early after {it + 1} iterations, error has plateaued")
+            break
+
+    if mode == "parallel":
+        executor.shutdown()
+    if checkpoint_writer is not None:
+        checkpoint_writer.close()
+
+    return object_field, probe, np.array(errors)
+
+
+def _upsample_object(object_field, ratio):
+    """
+    Interpolate a complex object field onto a grid ratio times finer.
+    """
+    height, width = object_field.shape
+    size = (width * ratio, height * ratio)
+    real = cv2.resize(object_field.real, size, interpolation=cv2.INTER_CUBIC)
+    imag = cv2.resize(object_field.imag, size, interpolation=cv2.INTER_CUBIC)
+    return real + 1j * imag
+
+
+def _offset_progress(callback, offset, progress):
+    """
+    Hand a progress report to callback with its iteration number offset.
+    """
+    callback(progress._replace(iteration=progress.iteration + offset))
+
+
+def multiresolution_engine(
+    diffraction_patterns,
+    positions_px,
+    pixel_size,
+    probe,
+    schedule=((4, 30), (2, 20), (1, 10)),
+    measured_amplitudes=None,
+    algorithm="pie",
+    probe_update_start=5,
+    callback=None,
+    **engine_options,
+):
+    """
+    Coarse-to-fine reconstruction: run PIE on the central crop of the diffraction
+    patterns first, at a fraction of the cost per iteration, and refine the result
+    at increasing resolution. Cropping the patterns by a factor f samples the
+    object at f times the pixel size, so the positions are divided by f and the
+    object is upsampled between levels. Each level resamples the native probe,
+    or upsamples the probe of the previous level once it has been refined.
+    :param diffraction_patterns: List of measured diffraction patterns.
+    :param positions_px: Array of probe positions in pixels (converted from micrometers).
+    :param pixel_size: Size of each pixel in micrometers.
+    :param probe: Initial probe field (native resolution).
+    :param schedule: Sequence of (crop factor, iterations) from coarse to fine;
+        each factor must be a multiple of the next one, and of the last one 1 to
+        end at native resolution.
+    :param measured_amplitudes: Preprocessed amplitude stack or DiffractionStack;
+        if given, diffraction_patterns may be None.
+    :param algorithm: Update rule of ptychographic_iterative_engine.
+    :param probe_update_start: Iteration of every level from which the probe is
+        refined, None to keep it fixed (see ptychographic_iterative_engine).
+    :param callback: Called with the progress.Progress report of every iteration,
+        numbered across the levels.
+    :param engine_options: Further arguments of ptychographic_iterative_engine,
+        applied at every level.
+    :return: Reconstructed object (the whole canvas spanned by the scan), probe
+        at the resolution of the last level and the errors of every level.
+    """
+    factors = [factor for factor, _ in schedule]
+    if any(coarse % fine for coarse, fine in zip(factors, factors[1:])):
+        raise ValueError(f"Crop factors {factors} must each divide the previous one")
+
+    if measured_amplitudes is None:
+        measured_amplitudes = prepare_amplitudes(diffraction_patterns, probe.shape)
+
+    # Canvas origin at the first position, so every level shares it
+    positions_px = np.asarray(positions_px, dtype=np.float64)
+    positions_px = positions_px[: len(measured_amplitudes)]
+    positions_px = positions_px - np.rint(positions_px.min(axis=0))
+
+    # A probe that was never refined is resampled from the native one, since the
+    # probe of a coarser level has lost its high frequencies
+    refine_probe = algorithm != "pie" and probe_update_start is not None
+    refined_probe = None
+
+    object_field, previous_factor, errors = None, None, []
+    for factor, iterations in schedule:
+        amplitudes = crop_amplitudes(measured_amplitudes, factor)
+        level_probe = fourier_resample(
+            probe if refined_probe is None else refined_probe, amplitudes.shape[1:]
+        )
+        if object_field is not None:
+            object_field = _upsample_object(object_field, previous_factor // factor)
+
+        print(f"Resolution level 1/{factor}, frames of {amplitudes.shape[1:]}")
+        object_field, level_probe, level_errors = ptychographic_iterative_engine(
+            None,
+            positions_px / factor,
+            pixel_size,
+            level_probe,
+            iterations,
+            measured_amplitudes=amplitudes,
+            object_guess=object_field,
+            algorithm=algorithm,
+            probe_update_start=probe_update_start,
+            # iterations keep counting across levels (snapshot numbers stay unique)
+            callback=(
+                None
+                if callback is None
+                else partial(_offset_progress, callback, len(errors))
+            ),
+            **engine_options,
+        )
+        if refine_probe and len(level_errors) > probe_update_start:
+            refined_probe = level_probe
+        errors.extend(level_errors)
+        previous_factor = factor
+
+    return object_field, level_probe, np.array(errors)
+
+
+def _project_exit_waves(
+    object_field, probe, spectra, measured_amplitudes, starts, group, beta, batch_size
+):
+    """
+    RAAR/Difference Map update of the exit waves of a group of positions, given the
+    current object; the exit waves are kept as their spectra, updated in place.
+    psi <- beta psi + (1 - 2 beta) P_O psi + beta P_F(2 P_O psi - psi), where P_O
+    makes the exit waves consistent with the object and P_F enforces the measured
+    amplitudes (beta = 1 is the Difference Map).
+    :param object_field: Complex object field (read only).
+    :param probe: Probe field.
+    :param spectra: Exit-wave spectra (N, height, width) of every position.
+    :param measured_amplitudes: Amplitude stack (array or DiffractionStack).
+    :param starts: Array (N, 2) of ROI origins (y_start, x_start).
+    :param group: Slice of the positions handled by this call.
+    :param beta: RAAR relaxation parameter.
+    :param batch_size: Number of positions transformed together.
+    :return: Partial overlap numerator sum(conj(probe) psi) over the bounding box
+        of the group, the object slices of that box, and the Fourier magnitude
+        error of the group.
+    """
+    height, width = probe.shape
+    y_min, x_min = starts[group].min(axis=0)
+    y_max, x_max = starts[group].max(axis=0) + (height, width)
+    numerator = np.zeros((y_max - y_min, x_max - x_min), dtype=object_field.dtype)
+    error = 0.0
+
+    for first in range(group.start, group.stop, batch_size):
+        batch = slice(first, min(first + batch_size, group.stop))
+        rows = (starts[batch, 0, None] + np.arange(height))[:, :, None]
+        cols = (starts[batch, 1, None] + np.arange(width))[:, None, :]
+
+        # Spectra of the exit waves consistent with the object, P_O psi
+        consistent = fft2c(object_field[rows, cols] * probe, overwrite_input=True)
+        amplitudes = measured_amplitudes[batch]
+        error += np.sum((np.abs(consistent) - amplitudes) ** 2)
+
+        # Modulus projection of the reflected exit waves, directly in Fourier space
+        reflected = 2 * consistent - spectra[batch]
+        projected = amplitudes * np.exp(1j * np.angle(reflected))
+
+        spectra[batch] *= beta
+        spectra[batch] += beta * projected + (1 - 2 * beta) * consistent
+
+        exit_waves = ifft2c(spectra[batch])
+        exit_waves *= probe.conj()
+        for (y, x), wave in zip((starts[batch] - (y_min, x_min)).tolist(), exit_waves):
+            numerator[y : y + height, x : x + width] += wave
+
+    return numerator, (slice(y_min, y_max), slice(x_min, x_max)), error
+
+
+def projection_engine(
+    diffraction_patterns,
+    positions_px,
+    pixel_size,
+    probe,
+    iterations=100,
+    algorithm="raar",
+    beta=0.75,
+    workers=None,
+    batch_size=16,
+    measured_amplitudes=None,
+    precision="double",
+    tolerance=None,
+    patience=5,
+    callback=None,
+    snapshot_every=10,
+    snapshot_downsample=1,
+):
+    """
+    Perform phase retrieval with a parallel projection algorithm (RAAR or the
+    Difference Map). Unlike PIE, every exit wave is updated from the same object,
+    so the positions are split into one group per worker and projected
+    concurrently on a thread pool (the FFTs and array operations release the
+    GIL); the object is then the single weighted reduction
+    sum(conj(probe) psi) / sum(|probe|^2) of all the exit waves.
+    The probe is kept fixed, and one exit wave per position is held in memory.
+    :param diffraction_patterns: List of measured diffraction patterns.
+    :param positions_px: Array of probe positions in pixels (converted from micrometers).
+    :param pixel_size: Size of each pixel in micrometers.
+    :param probe: Probe field.
+    :param iterations: Number of iterations.
+    :param algorithm: "raar" or "dm" (the Difference Map, RAAR with beta = 1).
+    :param beta: RAAR relaxation parameter.
+    :param workers: Number of threads, os.cpu_count() if None; each thread uses
+        single-threaded FFTs.
+    :param batch_size: Number of positions each thread transforms together.
+    :param measured_amplitudes: Preprocessed amplitude stack or DiffractionStack;
+        if given, diffraction_patterns may be None.
+    :param precision: "double" (complex128/float64) or "single" (complex64/float32).
+    :param tolerance: Stop early once the error improves by less than this fraction
+        over the last patience iterations; None always runs all iterations.
+    :param patience: Window (in iterations) of the early stopping rule.
+    :param callback: Called after every iteration with a progress.Progress report.
+    :param snapshot_every: Attach an object snapshot to the report every this many
+        iterations (and on the last one).
+    :param snapshot_downsample: Downsampling factor of the snapshots.
+    :return: Reconstructed object, probe and the normalized Fourier magnitude error
+        of every iteration that was run.
+    """
+    if algorithm not in PROJECTION_ALGORITHMS:
+        raise ValueError(
+            f"Unknown algorithm {algorithm!r}, expected one of {PROJECTION_ALGORITHMS}"
+        )
+    if batch_size < 1:
+        raise ValueError("batch_size must be a positive integer")
+    if precision not in PRECISIONS:
+        raise ValueError(
+            f"Unknown precision {precision!r}, expected one of {tuple(PRECISIONS)}"
+        )
+    if algorithm == "dm":
+        beta = 1.0
+
+    real_dtype, complex_dtype = PRECISIONS[precision]
+    probe = np.array(probe, dtype=complex_dtype)
+    measured_amplitudes, measured_intensity = _engine_amplitudes(
+        diffraction_patterns, measured_amplitudes, probe.shape, real_dtype
+    )
+
+    starts, _, canvas_shape = _scan_canvas(
+        positions_px[: len(measured_amplitudes)], probe.shape
+    )
+    rois = _roi_slices(starts, probe.shape)
+
+    object_field = _flat_object(canvas_shape, probe, measured_intensity, complex_dtype)
+
+    # Overlap weight of the fixed probe; uncovered pixels keep their initial value
+    illumination = np.zeros(object_field.shape, dtype=real_dtype)
+    for roi in rois:
+        illumination[roi] += np.abs(probe) ** 2
+    covered = illumination > 0
+    illumination += 1e-8 * illumination.max()
+
+    # Initial exit waves, consistent with the initial object
+    spectra = np.empty((len(rois), *probe.shape), dtype=complex_dtype)
+    for idx, roi in enumerate(rois):
+        spectra[idx] = fft2c(object_field[roi] * probe)
+
+    # One contiguous group of positions per worker, reduced in a fixed order
+    workers = min(workers or os.cpu_count() or 1, len(rois))
+    bounds = np.linspace(0, len(rois), workers + 1).astype(int)
+    groups = [slice(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+    project = partial(
+        _project_exit_waves,
+        probe=probe,
+        spectra=spectra,
+        measured_amplitudes=measured_amplitudes,
+        starts=starts,
+        beta=beta,
+        batch_size=batch_size,
+    )
+
+    total_intensity = float(np.sum(measured_intensity, dtype=np.float64)) * len(rois)
+    errors = []
+
+    backend = fft_backend_info()
+    print(
+        f"FFT backend: {backend['backend']} (1 worker per thread), "
+        f"{algorithm.upper()} on {workers} threads"
+    )
+
+    # The threads already share the cores, so each one transforms single-threaded
+    numerator = np.empty_like(object_field)
+    with ThreadPoolExecutor(
+        max_workers=workers, initializer=set_thread_fft_workers, initargs=(1,)
+    ) as executor:
+        for it in range(iterations):
+            numerator[...] = 0
+            error = 0.0
+            for partial_numerator, box, partial_error in executor.map(
+                lambda group: project(object_field, group=group), groups
+            ):
+                numerator[box] += partial_numerator
+                error += partial_error
+
+            # Overlap projection: weighted average of the exit waves on the object
+            np.divide(numerator, illumination, out=object_field, where=covered)
+
+            errors.append(error / total_intensity)
+            print(f"Iteration #{it}, error {errors[-1]:.4e}")
+
+            converged = _converged(errors, tolerance, patience)
+
+            if callback is not None:
+                snapshot = it % snapshot_every == 0 or converged or it == iterations - 1
+                callback(
+                    make_progress(
+                        it,
+                        errors[-1],
+                        object_field if snapshot else None,
+                        snapshot_downsample,
+                    )
+                )
+
+            if converged:
+                print(f"Stopping early after {it + 1} iterations, error has plateaued")
+                break
+
+    return object_field, probe, np.array(errors)
+
+
+def _negative_log_likelihood(intensity, amplitudes, noise):
+    """
+    Per-pixel negative log-likelihood (up to constants) of the predicted intensity.
+    """
+    if noise == "poisson":
+        return intensity - amplitudes**2 * np.log(intensity + 1e-12)
+    return (np.sqrt(intensity) - amplitudes) ** 2
+
+
+def _likelihood_derivatives(intensity, amplitudes, noise):
+    """
+    First and second derivatives of the per-pixel negative log-likelihood with
+    respect to the predicted intensity I: I - y log I for Poisson counts y = A^2,
+    (sqrt(I) - A)^2 for Gaussian noise on the amplitudes.
+    """
+    intensity = intensity + 1e-12
+    if noise == "poisson":
+        measured = amplitudes**2
+        return 1 - measured / intensity, measured / intensity**2
+    magnitude = np.sqrt(intensity)
+    return 1 - amplitudes / magnitude, amplitudes / (2 * intensity * magnitude)
+
+
+def _batch_rois(field, starts, height, width):
+    """
+    Stack (B, height, width) of the ROIs of a batch of positions, copied from field.
+    """
+    return np.stack([field[y : y + height, x : x + width] for y, x in starts.tolist()])
+
+
+def _likelihood_gradient(
+    object_field, probe, measured_amplitudes, starts, noise, batch_size
+):
+    """
+    Gradient of the negative log-likelihood with respect to the object (up to a
+    constant factor), accumulated over all positions in batches.
+    :return: Gradient on the object canvas and Fourier magnitude error.
+    """
+    height, width = probe.shape
+    gradient = np.zeros_like(object_field)
+    error = 0.0
+
+    for first in range(0, len(starts), batch_size):
+        batch = slice(first, first + batch_size)
+        amplitudes = measured_amplitudes[batch]
+
+        object_rois = _batch_rois(object_field, starts[batch], height, width)
+        spectra = fft2c(object_rois * probe, overwrite_input=True)
+        intensity = np.abs(spectra) ** 2
+        error += np.sum((np.sqrt(intensity) - amplitudes) ** 2)
+
+        # Back-propagate dL/dI * Phi to the exit waves, then to the object
+        spectra *= _likelihood_derivatives(intensity, amplitudes, noise)[0]
+        exit_waves = ifft2c(spectra, overwrite_input=True)
+        exit_waves *= probe.conj()
+        for (y, x), wave in zip(starts[batch].tolist(), exit_waves):
+            gradient[y : y + height, x : x + width] += wave
+
+    return gradient, error
+
+
+def _line_pass(
+    object_field,
+    direction,
+    probe,
+    measured_amplitudes,
+    starts,
+    noise,
+    batch_size,
+    steps,
+    derivatives=False,
+):
+    """
+    One pass over the positions, in batches, evaluating the negative log-likelihood
+    at a few step lengths along a search direction. The predicted intensity is
+    exactly quadratic in the step t, |Phi + t dPhi|^2 = I + t (b + t c), so once
+    the two FFTs of a batch are done every step only costs per-pixel arithmetic.
+    :param steps: Step lengths to evaluate.
+    :param derivatives: Also return the slope, curvature and Gauss-Newton
+        curvature of the likelihood at t = 0.
+    :return: Array of likelihoods (one per step), and the derivatives or None.
+    """
+    height, width = probe.shape
+    losses = np.zeros(len(steps))
+    slope, curvature, gauss_newton = 0.0, 0.0, 0.0
+
+    for first in range(0, len(starts), batch_size):
+        batch = slice(first, first + batch_size)
+        amplitudes = measured_amplitudes[batch]
+
+        spectra = fft2c(
+            _batch_rois(object_field, starts[batch], height, width) * probe,
+            overwrite_input=True,
+        )
+        variations = fft2c(
+            _batch_rois(direction, starts[batch], height, width) * probe,
+            overwrite_input=True,
+        )
+
+        intensity = np.abs(spectra) ** 2
+        linear = 2 * np.real(spectra.conj() * variations)
+        quadratic = np.abs(variations) ** 2
+        for index, step in enumerate(steps):
+            losses[index] += np.sum(
+                _negative_log_likelihood(
+                    intensity + step * (linear + step * quadratic), amplitudes, noise
+                )
+            )
+
+        if derivatives:
+            first_derivative, second_derivative = _likelihood_derivatives(
+                intensity, amplitudes, noise
+            )
+            slope += np.sum(first_derivative * linear)
+            curvature += np.sum(first_derivative * 2 * quadratic)
+            gauss_newton += np.sum(second_derivative * linear**2)
+
+    return losses, (slope, curvature, gauss_newton) if derivatives else None
+
+
+def _line_search_step(
+    object_field, direction, probe, measured_amplitudes, starts, noise, batch_size
+):
+    """
+    Step length along a search direction, streamed over the positions: nothing is
+    kept per position between passes, so the search needs the memory of a batch.
+    A first pass gives the Newton step at t = 0; each following pass evaluates
+    the exact likelihood at LINE_SEARCH_WINDOW multiples 2^k of it, moving down
+    (backtracking) or up (expansion) until the best step is bracketed by its
+    halved and doubled neighbours, since the Poisson likelihood is far from
+    quadratic where the predicted intensity is close to zero. A last pass tries
+    the vertex of the parabola through the bracket and the points between.
+    :return: Step length along the direction.
+    """
+    line = partial(
+        _line_pass,
+        object_field,
+        direction,
+        probe,
+        measured_amplitudes,
+        starts,
+        noise,
+        batch_size,
+    )
+    (initial,), (slope, curvature, gauss_newton) = line([0.0], derivatives=True)
+
+    # Newton step, with the Gauss-Newton (always positive) curvature as fallback
+    curvature += gauss_newton
+    if curvature <= 0:
+        curvature = gauss_newton
+    newton = -slope / (curvature + 1e-30)
+
+    # Likelihood at newton * 2^k of every exponent k evaluated so far
+    losses = {}
+    window = range(-(LINE_SEARCH_WINDOW // 2), LINE_SEARCH_WINDOW // 2)
+    while True:
+        values, _ = line([newton * 2.0**k for k in window])
+        losses.update(zip(window, values))
+        best, lowest, highest = min(losses, key=losses.get), min(losses), max(losses)
+
+        if losses[best] >= initial or best == lowest:
+            if lowest <= -LINE_SEARCH_STEPS:
+                if losses[best] >= initial:
+                    return 0.0
+                break
+            window = range(max(lowest - LINE_SEARCH_WINDOW, -LINE_SEARCH_STEPS), lowest)
+        elif best == highest and highest < LINE_SEARCH_STEPS:
+            window = range(
+                highest + 1,
+                min(highest + 1 + LINE_SEARCH_WINDOW, LINE_SEARCH_STEPS + 1),
+            )
+        else:
+            break
+
+    step = newton * 2.0**best
+    if best - 1 not in losses or best + 1 not in losses:
+        return step
+
+    # Parabola through (step / 2, step, 2 step), and the points between them
+    below, above = losses[best - 1], losses[best + 1]
+    numerator = (losses[best] - above) / 4 - (losses[best] - below)
+    denominator = (losses[best] - above) / 2 + (losses[best] - below)
+    candidates = [step / np.sqrt(2), step * np.sqrt(2)]
+    if denominator != 0:
+        vertex = step * (1 - numerator / (2 * denominator))
+        if step / 2 < vertex < 2 * step:
+            candidates.append(vertex)
+    values, _ = line(candidates)
+    if values.min() < losses[best]:
+        step = candidates[int(np.argmin(values))]
+    return step
+
+
+def maximum_likelihood_engine(
+    diffraction_patterns,
+    positions_px,
+    pixel_size,
+    probe,
+    iterations=30,
+    noise="poisson",
+    batch_size=16,
+    measured_amplitudes=None,
+    precision="double",
+    tolerance=None,
+    patience=5,
+    callback=None,
+    snapshot_every=10,
+    snapshot_downsample=1,
+    object_guess=None,
+):
+    """
+    Perform phase retrieval by minimizing the negative log-likelihood of the
+    measured patterns with preconditioned nonlinear conjugate gradients
+    (Polak-Ribiere), instead of replacing the Fourier amplitudes. Noisy, low
+    exposure data are fitted rather than enforced, and the whole object moves
+    at once, so tens of iterations are usually enough. Each iteration costs two
+    transforms per position for the gradient and two per pass of the line search
+    (usually three), computed in batches, so memory stays that of a batch.
+    The probe is kept fixed.
+    :param diffraction_patterns: List of measured diffraction patterns.
+    :param positions_px: Array of probe positions in pixels (converted from micrometers).
+    :param pixel_size: Size of each pixel in micrometers.
+    :param probe: Probe field.
+    :param iterations: Number of conjugate gradient iterations.
+    :param noise: "poisson" (photon counting) or "gaussian" (on the amplitudes).
+    :param batch_size: Number of positions transformed together.
+    :param measured_amplitudes: Preprocessed amplitude stack or DiffractionStack;
+        if given, diffraction_patterns may be None.
+    :param precision: "double" (complex128/float64) or "single" (complex64/float32).
+    :param tolerance: Stop early once the error improves by less than this fraction
+        over the last patience iterations; None always runs all iterations.
+    :param patience: Window (in iterations) of the early stopping rule.
+    :param callback: Called after every iteration with a progress.Progress report.
+    :param snapshot_every: Attach an object snapshot to the report every this many
+        iterations (and on the last one).
+    :param snapshot_downsample: Downsampling factor of the snapshots.
+    :param object_guess: Initial object on the canvas (e.g. the result of a few
+        PIE or RAAR iterations); None starts from a flat object of the measured
+        energy.
+    :return: Reconstructed object, probe and the normalized Fourier magnitude error
+        of every iteration that was run.
+    """
+    if noise not in NOISE_MODELS:
+        raise ValueError(
+            f"Unknown noise model {noise!r}, expected one of {NOISE_MODELS}"
+        )
+    if batch_size < 1:
+        raise ValueError("batch_size must be a positive integer")
+    if precision not in PRECISIONS:
+        raise ValueError(
+            f"Unknown precision {precision!r}, expected one of {tuple(PRECISIONS)}"
+        )
+
+    real_dtype, complex_dtype = PRECISIONS[precision]
+    probe = np.array(probe, dtype=complex_dtype)
+    measured_amplitudes, measured_intensity = _engine_amplitudes(
+        diffraction_patterns, measured_amplitudes, probe.shape, real_dtype
+    )
+
+    starts, _, canvas_shape = _scan_canvas(
+        positions_px[: len(measured_amplitudes)], probe.shape
+    )
+
+    if object_guess is None:
+        # gradient steps recover poorly from an initial guess of the wrong scale
+        object_field = _flat_object(
+            canvas_shape, probe, measured_intensity, complex_dtype
+        )
+    else:
+        object_field = _fit_canvas(object_guess, canvas_shape).astype(complex_dtype)
+
+    # Diagonal preconditioner: inverse of the illumination of every object pixel
+    illumination = np.zeros(object_field.shape, dtype=real_dtype)
+    for roi in _roi_slices(starts, probe.shape):
+        illumination[roi] += np.abs(probe) ** 2
+    preconditioner = 1 / (illumination + 1e-3 * illumination.max())
+
+    gradient_args = (probe, measured_amplitudes, starts, noise, batch_size)
+    total_intensity = float(np.sum(measured_intensity, dtype=np.float64)) * len(starts)
+    errors = []
+    direction, previous_gradient, previous_scaled = None, None, None
+
+    backend = fft_backend_info()
+    print(f"FFT backend: {backend['backend']} ({backend['workers']} workers)")
+
+    for it in range(iterations):
+        gradient, error = _likelihood_gradient(object_field, *gradient_args)
+        scaled = preconditioner * gradient
+
+        # Polak-Ribiere conjugation, restarted whenever it stops being a descent
+        if direction is None:
+            direction = -scaled
+        else:
+            conjugation = np.real(np.vdot(scaled, gradient - previous_gradient)) / (
+                np.real(np.vdot(previous_scaled, previous_gradient)) + 1e-30
+            )
+            direction = -scaled + max(conjugation, 0.0) * direction
+        previous_gradient, previous_scaled = gradient, scaled
+
+        step = _line_search_step(object_field, direction, *gradient_args)
+        object_field += step * direction
+
+        errors.append(error / total_intensity)
+        print(f"Iteration #{it}, error {errors[-1]:.4e}, step {step:.3e}")
+
+        converged = _converged(errors, tolerance, patience)
+
+        if callback is not None:
+            snapshot = it % snapshot_every == 0 or converged or it == iterations - 1
+            callback(
+                make_progress(
+                    it,
+                    errors[-1],
+                    object_field if snapshot else None,
+                    snapshot_downsample,
+                )
+            )
+
+        if converged:
+            print(f"Stopping early after {it + 1} iterations, error has plateaued")
+            break
+
+    return object_field, probe, np.array(errors)
+
+
+def _tile_worker(spec, probe, object_weight, amplitudes, rois, connection):
+    """
+    Worker process of tiled_engine: run PIE sweeps over the positions of one tile,
+    on the tile held in shared memory, whenever the parent asks for them.
+    :param spec: SharedArray.spec() of the tile.
+    :param probe: Probe field.
+    :param object_weight: Object feedback weight of the probe.
+    :param amplitudes: Measured amplitudes of the positions of the tile.
+    :param rois: Object slices of the positions, relative to the tile.
+    :param connection: Pipe end receiving the number of iterations to run (None
+        to stop) and sending back the error of every iteration.
+    """
+    shape, dtype, name = spec
+    tile = SharedArray(shape, dtype, name)
+    try:
+        while (iterations := connection.recv()) is not None:
+            errors = []
+            for _ in range(iterations):
+                error = 0.0
+                for amplitude, roi in zip(amplitudes, rois):
+                    error += _update_position(
+                        tile.array, probe, object_weight, amplitude, roi
+                    )
+                errors.append(error)
+            connection.send(errors)
+    finally:
+        tile.close()
+
+
+def tiled_engine(
+    diffraction_patterns,
+    positions_px,
+    pixel_size,
+    probe,
+    iterations=100,
+    beta=0.9,
+    algorithm="pie",
+    alpha=0.1,
+    tiles=(2, 2),
+    sync_every=5,
+    measured_amplitudes=None,
+    precision="double",
+    tolerance=None,
+    patience=5,
+    callback=None,
+    snapshot_every=10,
+    snapshot_downsample=1,
+):
+    """
+    Perform phase retrieval with PIE on a domain decomposition of the object, for
+    canvases too large for one process. The canvas is split into a grid of tiles,
+    each held in multiprocessing.shared_memory and swept by its own worker process
+    over the positions it owns. Every sync_every iterations the tiles are merged
+    into the canvas, weighted by their illumination, and copied back, which
+    synchronizes their overlapping borders. The workers only exchange iteration
+    counts and errors with the parent, so the same partition could be run by
+    remote workers. The probe is kept fixed.
+    :param diffraction_patterns: List of measured diffraction patterns.
+    :param positions_px: Array of probe positions in pixels (converted from micrometers).
+    :param pixel_size: Size of each pixel in micrometers.
+    :param probe: Probe field.
+    :param iterations: Number of iterations for PIE.
+    :param beta: Feedback parameter for object update.
+    :param algorithm: Object update rule, "pie", "epie" or "rpie" (see
+        ptychographic_iterative_engine).
+    :param alpha: rPIE regularization of the object update.
+    :param tiles: Number of tiles (rows, columns), i.e. at most rows * columns processes.
+    :param sync_every: Number of iterations between border synchronizations.
+    :param measured_amplitudes: Preprocessed amplitude stack or DiffractionStack;
+        if given, diffraction_patterns may be None.
+    :param precision: "double" (complex128/float64) or "single" (complex64/float32).
+    :param tolerance: Stop early once the error improves by less than this fraction
+        over the last patience iterations (checked at synchronizations); None
+        always runs all iterations.
+    :param patience: Window (in iterations) of the early stopping rule.
+    :param callback: Called after every iteration with a progress.Progress report;
+        snapshots are only attached at synchronizations.
+    :param snapshot_every: Attach an object snapshot to the report every this many
+        iterations (at the next synchronization, and on the last one).
+    :param snapshot_downsample: Downsampling factor of the snapshots.
+    :return: Reconstructed object, probe and the normalized Fourier magnitude error
+        of every iteration that was run.
+    """
+    if algorithm not in FIXED_PROBE_ALGORITHMS:
+        raise ValueError(
+            f"Unknown algorithm {algorithm!r}, expected one of {FIXED_PROBE_ALGORITHMS}"
+        )
+    if sync_every < 1:
+        raise ValueError("sync_every must be a positive integer")
+    if precision not in PRECISIONS:
+        raise ValueError(
+            f"Unknown precision {precision!r}, expected one of {tuple(PRECISIONS)}"
+        )
+
+    real_dtype, complex_dtype = PRECISIONS[precision]
+    probe = np.array(probe, dtype=complex_dtype)
+    measured_amplitudes, measured_intensity = _engine_amplitudes(
+        diffraction_patterns, measured_amplitudes, probe.shape, real_dtype
+    )
+
+    starts, _, canvas_shape = _scan_canvas(
+        positions_px[: len(measured_amplitudes)], probe.shape
+    )
+
+    object_field = _flat_object(canvas_shape, probe, measured_intensity, complex_dtype)
+
+    if algorithm == "pie":
+        object_weight = _feedback_weight(probe, beta)
+    else:
+        object_alpha = 1.0 if algorithm == "epie" else alpha
+        object_weight = _regularized_weight(probe, object_alpha, beta)
+
+    partition = partition_tiles(starts, probe.shape, object_field.shape, tiles)
+
+    # Illumination of every tile, weighting its pixels when the tiles are merged
+    weights = []
+    total_weight = np.zeros(object_field.shape, dtype=real_dtype)
+    for tile in partition:
+        y_start, _, x_start, _ = tile.extent
+        weight = np.zeros(object_field[tile_slices(tile.extent)].shape, real_dtype)
+        for roi in _roi_slices(
+            starts[tile.positions] - (y_start, x_start), probe.shape
+        ):
+            weight[roi] += np.abs(probe) ** 2
+        total_weight[tile_slices(tile.extent)] += weight
+        weights.append(weight)
+    covered = total_weight > 0
+
+    total_intensity = float(np.sum(measured_intensity, dtype=np.float64)) * len(starts)
+    errors = []
+    print(
+        f"{len(partition)} tiles on as many processes, synchronized every {sync_every} iterations"
+    )
+
+    shared, connections, workers = [], [], []
+    try:
+        for tile in partition:
+            y_start, _, x_start, _ = tile.extent
+            array = SharedArray(
+                object_field[tile_slices(tile.extent)].shape, complex_dtype
+            )
+            array.array[...] = object_field[tile_slices(tile.extent)]
+            shared.append(array)
+
+            parent_end, worker_end = multiprocessing.Pipe()
+            worker = multiprocessing.Process(
+                target=_tile_worker,
+                args=(
+                    array.spec(),
+                    probe,
+                    object_weight,
+                    np.asarray(measured_amplitudes[tile.positions], dtype=real_dtype),
+                    _roi_slices(
+                        starts[tile.positions] - (y_start, x_start), probe.shape
+                    ),
+                    worker_end,
+                ),
+                daemon=True,
+            )
+            worker.start()
+            # only the worker holds its end, so the parent sees EOFError if it dies
+            worker_end.close()
+            connections.append(parent_end)
+            workers.append(worker)
+
+        it = 0
+        converged = False
+        while it < iterations and not converged:
+            rounds = min(sync_every, iterations - it)
+            for connection in connections:
+                connection.send(rounds)
+            tile_errors = np.sum(
+                [connection.recv() for connection in connections], axis=0
+            )
+
+            # Synchronize the borders: illumination-weighted merge, then copy back
+            merged = np.zeros_like(object_field)
+            for array, weight, tile in zip(shared, weights, partition):
+                merged[tile_slices(tile.extent)] += weight * array.array
+            np.divide(merged, total_weight, out=object_field, where=covered)
+            for array, tile in zip(shared, partition):
+                array.array[...] = object_field[tile_slices(tile.extent)]
+
+            for offset, error in enumerate(tile_errors):
+                errors.append(error / total_intensity)
+                print(f"Iteration #{it}, error {errors[-1]:.4e}")
+
+                # The object is only consistent at the end of the round
+                synchronized = offset == rounds - 1
+                if synchronized:
+                    converged = _converged(errors, tolerance, patience)
+
+                if callback is not None:
+                    snapshot = synchronized and (
+                        it // snapshot_every > (it - rounds) // snapshot_every
+                        or converged
+                        or it == iterations - 1
+                    )
+                    callback(
+                        make_progress(
+                            it,
+                            errors[-1],
+                            object_field if snapshot else None,
+                            snapshot_downsample,
+                        )
+                    )
+                it += 1
+
+        if converged:
+            print(f"Stopping early after {it} iterations, error has plateaued")
+    finally:
+        try:
+            for connection in connections:
+                # the pipe of a worker that died is closed; its error is raised instead
+                try:
+                    connection.send(None)
+                except OSError:
+                    pass
+                connection.close()
+            for worker in workers:
+                worker.join()
+        finally:
+            for array in shared:
+                array.unlink()
+
+    return object_field, probe, np.array(errors)
+
+
+class OnlineReconstruction:
+    """
+    PIE reconstruction that runs while the scan is being acquired. Frames are
+    handed over one by one with their stage coordinate (e.g. by Ptychography after
+    every written_signal of the camera, or by a processing pipeline); a background
+    thread folds them in and keeps sweeping over all the frames received so far,
+    so the object is close to final when the scan ends.
+    The canvas is sized from the planned scan coordinates, and the probe is fixed.
+    An error of the background thread (e.g. an unreadable image) stops it and is
+    raised by the next add_frame(), add_image() or finish().
+    """
+
+    def __init__(
+        self,
+        coordinates,
+        pixel_size,
+        probe,
+        beta=0.9,
+        algorithm="rpie",
+        alpha=0.1,
+        min_frames=4,
+        precision="double",
+        callback=None,
+        snapshot_every=10,
+        snapshot_downsample=1,
+    ):
+        """
+        :param coordinates: Planned scan coordinates (N, 2) in micrometers, as saved
+            to coordinates.csv by the acquisition.
+        :param pixel_size: Size of each pixel in micrometers.
+        :param probe: Probe field; frames are resized to its shape.
+        :param beta: Feedback parameter for object update.
+        :param algorithm: Object update rule, "pie", "epie" or "rpie".
+        :param alpha: rPIE regularization of the object update.
+        :param min_frames: Number of frames received before the updates start, so
+            the first positions already overlap each other.
+        :param precision: "double" (complex128/float64) or "single" (complex64/float32).
+        :param callback: Called after every sweep with a progress.Progress report;
+            it runs on the reconstruction thread and must not block.
+        :param snapshot_every: Attach an object snapshot every this many sweeps.
+        :param snapshot_downsample: Downsampling factor of the snapshots.
+        """
+        if algorithm not in FIXED_PROBE_ALGORITHMS:
+            raise ValueError(
+                f"Unknown algorithm {algorithm!r}, expected one of {FIXED_PROBE_ALGORITHMS}"
+            )
+        if precision not in PRECISIONS:
+            raise ValueError(
+                f"Unknown precision {precision!r}, expected one of {tuple(PRECISIONS)}"
+            )
+
+        self.real_dtype, complex_dtype = PRECISIONS[precision]
+        self.probe = np.array(probe, dtype=complex_dtype)
+        self.pixel_size = pixel_size
+        self.min_frames = min_frames
+        self.callback = callback
+        self.snapshot_every = snapshot_every
+        self.snapshot_downsample = snapshot_downsample
+
+        if algorithm == "pie":
+            self.object_weight = _feedback_weight(self.probe, beta)
+        else:
+            object_alpha = 1.0 if algorithm == "epie" else alpha
+            self.object_weight = _regularized_weight(self.probe, object_alpha, beta)
+
+        # Canvas spanned by the planned positions
+        positions_px = np.asarray(coordinates) / pixel_size
+        shifted, _, self.canvas_shape = _scan_canvas(positions_px, self.probe.shape)
+        self.origin = shifted[0] - split_positions(positions_px[:1])[0][0]
+        self.object_field = None
+
+        self.amplitudes, self.rois, self.errors = [], [], []
+        self.total_intensity = 0.0
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.final_sweeps = 0
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _roi(self, coordinate):
+        """
+        Object slices of a stage coordinate, raising if it falls off the canvas.
+        """
+        start, _ = split_positions(np.asarray([coordinate]) / self.pixel_size)
+        y_start, x_start = (start[0] + self.origin).tolist()
+        height, width = self.probe.shape
+        if (
+            min(y_start, x_start) < 0
+            or y_start + height > self.canvas_shape[0]
+            or x_start + width > self.canvas_shape[1]
+        ):
+            raise ValueError(f"Coordinate {coordinate} is outside the planned scan")
+        return slice(y_start, y_start + height), slice(x_start, x_start + width)
+
+    def add_frame(self, pattern, coordinate):
+        """
+        Hand over a measured diffraction pattern (normalized to [0, 1]) and its
+        stage coordinate in micrometers.
+        """
+        self._raise_error()
+        self.queue.put((pattern, self._roi(coordinate)))
+
+    def add_image(self, image_path, coordinate):
+        """
+        Hand over a written 16-bit image, decoded on the reconstruction thread.
+        """
+        self._raise_error()
+        self.queue.put((image_path, self._roi(coordinate)))
+
+    def _ingest(self, pattern, roi):
+        if isinstance(pattern, str):
+            pattern = read_pattern(pattern)
+        amplitude = prepare_amplitudes([pattern], self.probe.shape)[0]
+        amplitude = amplitude.astype(self.real_dtype, copy=False)
+        intensity = float(np.sum(np.square(amplitude, dtype=np.float64)))
+
+        if self.object_field is None:
+            # energy of the first frame, the only one known so far
+            self.object_field = _flat_object(
+                self.canvas_shape, self.probe, intensity, self.probe.dtype
+            )
+
+        self.amplitudes.append(amplitude)
+        self.rois.append(roi)
+        self.total_intensity += intensity
+
+    def _sweep(self):
+        """
+        PIE sweep over every frame received so far, newest frames included.
+        """
+        error = 0.0
+        for amplitude, roi in zip(self.amplitudes, self.rois):
+            with self.lock:
+                error += _update_position(
+                    self.object_field, self.probe, self.object_weight, amplitude, roi
+                )
+
+        sweep = len(self.errors)
+        self.errors.append(error / self.total_intensity)
+        if self.callback is not None:
+            snapshot = sweep % self.snapshot_every == 0
+            with self.lock:
+                self.callback(
+                    make_progress(
+                        sweep,
+                        self.errors[-1],
+                        self.object_field if snapshot else None,
+                        self.snapshot_downsample,
+                    )
+                )
+
+    def _run(self):
+        try:
+            self._reconstruct()
+        except Exception as error:
+            self.error = error
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def _reconstruct(self):
+        finished = False
+        while True:
+            # Wait for frames only while there are not enough of them to refine
+            items = []
+            if not finished and len(self.amplitudes) < self.min_frames:
+                items.append(self.queue.get())
+            while True:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            for item in items:
+                if item is None:
+                    finished = True
+                else:
+                    self._ingest(*item)
+
+            if len(self.amplitudes) < self.min_frames:
+                if finished:
+                    break
+                continue
+            if finished:
+                if self.final_sweeps == 0:
+                    break
+                self.final_sweeps -= 1
+            self._sweep()
+
+    def snapshot(self):
+        """
+        Copy of the current object (the whole canvas), None before the first frame.
+        """
+        with self.lock:
+            return None if self.object_field is None else self.object_field.copy()
+
+    def finish(self, iterations=10):
+        """
+        Stop accepting frames and refine the complete scan for a few more sweeps.
+        :param iterations: Number of final sweeps over all the frames.
+        :return: Reconstructed object (the whole canvas), probe and the normalized
+            Fourier magnitude error of every sweep.
+        """
+        self.final_sweeps = iterations
+        self.queue.put(None)
+        self.thread.join()
+        self._raise_error()
+        return self.object_field, self.probe, np.array(self.errors)
@@ -0,0 +1,302 @@
+import os
+import threading
+
+import numpy as np
+
+try:
+    import pyfftw  # type: ignore
+except ImportError:
+    pyfftw = None
+
+try:
+    import scipy.fft as scipy_fft  # type: ignore
+except ImportError:
+    scipy_fft = None
+
+# Backends in order of preference when none is requested explicitly
+FFT_BACKENDS = ("pyfftw", "scipy", "numpy")
+
+# Axes of the 2D transforms, so stacks of frames are transformed in one call
+FFT_AXES = (-2, -1)
+
+# Per-thread override of the number of FFT threads (see set_thread_fft_workers)
+_thread_settings = threading.local()
+
+
+def _keep_precision(y, x):
+    """
+    Cast a transform back to the precision of its input (numpy < 2 always returns complex128).
+    """
+    return y.astype(np.result_type(x.dtype, np.complex64), copy=False)
+
+
+def _store(y, out, shared=False):
+    """
+    Copy a transform into out; if out is None, return it as is, or a copy if
+    shared (pyfftw plans return their own output buffer, which the next call
+    overwrites).
+    """
+    if out is None:
+        return y.copy() if shared else y
+    if y is not out:
+        np.copyto(out, y)
+    return out
+
+
+class FFTBackend:
+    """
+    2D FFT backend selected at runtime among pyfftw, scipy.fft and numpy.
+    Plans are created once per (shape, dtype, direction) and reused for the whole run;
+    pyfftw plans own their buffers, so every calling thread gets its own plans.
+    """
+
+    def __init__(self, name=None, workers=None):
+        """
+        :param name: "pyfftw", "scipy" or "numpy"; the first available one if None.
+        :param workers: Number of FFT threads, all available cores if None.
+        """
+        available = {
+            "pyfftw": pyfftw is not None,
+            "scipy": scipy_fft is not None,
+            "numpy": True,
+        }
+
+        if name is None:
+            name = next(backend for backend in FFT_BACKENDS if available[backend])
+        elif name not in FFT_BACKENDS:
+            raise ValueError(
+                f"Unknown FFT backend {name!r}, expected one of {FFT_BACKENDS}"
+            )
+        elif not available[name]:
+            raise ImportError(f"FFT backend {name!r} is not installed")
+
+        self.name = name
+        # numpy.fft has no threading support
+        self.workers = 1 if name == "numpy" else (workers or os.cpu_count() or 1)
+        self.plans = {}
+
+        if name == "pyfftw":
+            # keep the wisdom gathered by the planner for the whole run
+            pyfftw.interfaces.cache.enable()
+
+    def info(self):
+        """
+        Report the chosen backend and thread count.
+        :return: Dictionary with the backend name, worker count and cached plans.
+        """
+        return {"backend": self.name, "workers": self.workers, "plans": len(self.plans)}
+
+    def _workers(self):
+        """
+        Number of FFT threads of the calling thread.
+        """
+        if self.name == "numpy":
+            return 1
+        return getattr(_thread_settings, "workers", None) or self.workers
+
+    def _plan(self, x, inverse):
+        """
+        Get (or build) the pyfftw plan for the shape and dtype of x, in this thread.
+        """
+        workers = self._workers()
+        key = (x.shape, x.dtype.str, inverse, threading.get_ident(), workers)
+        plan = self.plans.get(key)
+
+        if plan is None:
+            builder = pyfftw.builders.ifft2 if inverse else pyfftw.builders.fft2
+            plan = builder(
+                pyfftw.empty_aligned(x.shape, dtype=x.dtype),
+                axes=FFT_AXES,
+                threads=workers,
+                planner_effort="FFTW_MEASURE",
+            )
+            self.plans[key] = plan
+
+        return plan
+
+    def fft2(self, x, out=None):
+        """
+        Perform a 2D Fourier transform over the last two axes of x.
+        :param out: Array receiving the transform (may be x itself); a new array
+            is returned if None.
+        """
+        if self.name == "pyfftw":
+            return _store(self._plan(x, False)(x), out, shared=True)
+        if self.name == "scipy":
+            # pocketfft caches its plans internally, keyed by shape and dtype
+            self.plans.setdefault((x.shape, x.dtype.str, False), True)
+            return _store(
+                scipy_fft.fft2(
+                    x, axes=FFT_AXES, workers=self._workers(), overwrite_x=x is out
+                ),
+                out,
+            )
+        return _store(_keep_precision(np.fft.fft2(x, axes=FFT_AXES), x), out)
+
+    def ifft2(self, x, out=None):
+        """
+        Perform a 2D inverse Fourier transform over the last two axes of x.
+        :param out: Array receiving the transform (may be x itself); a new array
+            is returned if None.
+        """
+        if self.name == "pyfftw":
+            return _store(self._plan(x, True)(x), out, shared=True)
+        if self.name == "scipy":
+            self.plans.setdefault((x.shape, x.dtype.str, True), True)
+            return _store(
+                scipy_fft.ifft2(
+                    x, axes=FFT_AXES, workers=self._workers(), overwrite_x=x is out
+                ),
+                out,
+            )
+        return _store(_keep_precision(np.fft.ifft2(x, axes=FFT_AXES), x), out)
+
+
+# Backend shared by every caller, created on first use
+_backend = None
+
+
+def get_fft_backend():
+    """
+    Get the FFT backend of the run, selecting the default one on first use.
+    """
+    global _backend
+    if _backend is None:
+        _backend = FFTBackend()
+    return _backend
+
+
+def set_fft_backend(name=None, workers=None):
+    """
+    Select the FFT backend of the run, dropping the plans of the previous one.
+    :param name: "pyfftw", "scipy" or "numpy"; the first available one if None.
+    :param workers: Number of FFT threads, all available cores if None.
+    :return: The new backend.
+    """
+    global _backend
+    _backend = FFTBackend(name, workers)
+    return _backend
+
+
+def set_thread_fft_workers(workers):
+    """
+    Set the number of FFT threads of the calling thread, e.g. 1 in the threads of
+    a pool, so that pool threads times FFT threads do not oversubscribe the cores.
+    :param workers: Number of FFT threads, None for the backend's.
+    """
+    _thread_settings.workers = workers
+
+
+def fft_backend_info():
+    """
+    Report which FFT backend and how many threads the run uses.
+    """
+    return get_fft_backend().info()
+
+
+# Cached +-1 checkerboard masks of the centered transforms, keyed by grid shape and dtype
+_checkerboards = {}
+
+
+def _real_dtype(x):
+    """
+    Real floating dtype matching the precision of x.
+    """
+    if np.issubdtype(x.dtype, np.inexact):
+        return np.finfo(x.dtype).dtype
+    return np.dtype(np.float64)
+
+
+def _checkerboard(shape, dtype):
+    """
+    Get the input and output masks of a shift-free centered transform.
+    For even grids fftshift(fft2(ifftshift(x))) equals s * M * fft2(M * x), with
+    M[n, m] = (-1)^(n + m) and the global sign s = (-1)^(H/2 + W/2); the same
+    holds for the inverse transform.
+    :param shape: Even grid shape (last two axes).
+    :param dtype: Real dtype of the masks.
+    :return: Input mask M and output mask s * M.
+    """
+    key = (shape, dtype.str)
+    masks = _checkerboards.get(key)
+
+    if masks is None:
+        rows, cols = np.indices(shape)
+        mask = (1 - 2 * ((rows + cols) % 2)).astype(dtype)
+        sign = -1 if (shape[0] // 2 + shape[1] // 2) % 2 else 1
+        masks = (mask, mask * sign)
+        _checkerboards[key] = masks
+
+    return masks
+
+
+def _centered(transform, x, overwrite_input):
+    """
+    Apply a 2D transform centered on the grid, over the last two axes of x.
+    Even grids use the cached checkerboard masks instead of the two shift copies;
+    odd grids fall back to ifftshift/fftshift.
+    :param transform: FFT of the backend (fft2 or ifft2).
+    :param x: Input array (2D frame or stack of frames).
+    :param overwrite_input: Allow the input mask to be applied in place on x.
+    """
+    shape = x.shape[-2:]
+
+    if shape[0] % 2 or shape[1] % 2:
+        return np.fft.fftshift(
+            transform(np.fft.ifftshift(x, axes=FFT_AXES)), axes=FFT_AXES
+        )
+
+    pre, post = _checkerboard(shape, _real_dtype(x))
+
+    if overwrite_input and np.iscomplexobj(x):
+        x *= pre
+    else:
+        x = x * pre
+
+    y = transform(x)
+    y *= post
+    return y
+
+
+def fft2c(x, overwrite_input=False):
+    """
+    Perform a centered 2D Fourier transform (over the last two axes for stacks).
+    :param x: Input array.
+    :param overwrite_input: Allow x to be modified to save a temporary copy.
+    """
+    return _centered(get_fft_backend().fft2, x, overwrite_input)
+
+
+def ifft2c(x, overwrite_input=False):
+    """
+    Perform a centered 2D inverse Fourier transform (over the last two axes for stacks).
+    :param x: Input array.
+    :param overwrite_input: Allow x to be modified to save a temporary copy.
+    """
+    return _centered(get_fft_backend().ifft2, x, overwrite_input)
+
+
+def fourier_resample(x, shape):
+    """
+    Band-limited resampling of a field by cropping or zero-padding its centered
+    spectrum; the values are scaled so the field keeps its magnitude.
+    :param x: 2D field.
+    :param shape: Target shape (height, width).
+    :return: Complex field of the target shape.
+    """
+    spectrum = fft2c(x)
+    resampled = np.zeros(shape, dtype=spectrum.dtype)
+
+    # Overlap of the two centered spectra along each axis
+    source, target = [], []
+    for size, new_size in zip(x.shape, shape):
+        common = min(size, new_size)
+        source.append(slice(size // 2 - common // 2, size // 2 - common // 2 + common))
+        target.append(
+            slice(new_size // 2 - common // 2, new_size // 2 - common // 2 + common)
+        )
+    resampled[tuple(target)] = spectrum[tuple(source)]
+
+    resampled = ifft2c(resampled, overwrite_input=True)
+    resampled *= (shape[0] * shape[1]) / (x.shape[0] * x.shape[1])
+    return resampled
@@ -0,0 +1,141 @@
+import types
+
+import numpy as np
+
+from fft_backend import get_fft_backend
+
+try:
+    import numba as nb  # type: ignore
+except ImportError:
+    nb = None
+
+# Kernels accepted by the reconstruction engine
+KERNELS = ("numpy", "numba")
+
+
+def kernels_available(name):
+    """
+    Check whether a kernel implementation can be used in this environment.
+    """
+    return name == "numpy" or (name == "numba" and nb is not None)
+
+
+def _compile(kernel, parallel):
+    """
+    Compile a kernel to run on numba's thread pool (parallel) or single-threaded,
+    for callers that are already threads of a pool; the single-threaded variant
+    is renamed, so each variant has its own on-disk cache.
+    """
+    if not parallel:
+        kernel = types.FunctionType(
+            kernel.__code__, kernel.__globals__, f"{kernel.__name__}_serial"
+        )
+        kernel.__qualname__ = kernel.__name__
+    return nb.njit(parallel=parallel, cache=True)(kernel)
+
+
+if nb is not None:
+
+    def _exit_wave(object_field, y_start, x_start, probe, out):
+        """
+        out = M * object[roi] * probe, with M[n, m] = (-1)^(n + m) the input mask
+        of the centered transform (see fft_backend._checkerboard).
+        """
+        height, width = probe.shape
+        for i in nb.prange(height):
+            for j in range(width):
+                sign = 1 - 2 * ((i + j) & 1)
+                out[i, j] = sign * object_field[y_start + i, x_start + j] * probe[i, j]
+
+    def _modulus_constraint(spectrum, amplitude):
+        """
+        Replace the magnitudes of an (uncentered) spectrum with the measured ones,
+        in place, as the ratio amplitude / |spectrum| instead of exp(1j angle).
+        The checkerboard signs of the centered transforms cancel between the
+        forward output and the inverse input, so no mask is applied here.
+        :return: Fourier magnitude error sum((|spectrum| - amplitude)^2).
+        """
+        height, width = spectrum.shape
+        error = 0.0
+        for i in nb.prange(height):
+            for j in range(width):
+                magnitude = abs(spectrum[i, j])
+                error += (magnitude - amplitude[i, j]) ** 2
+                if magnitude > 0:
+                    spectrum[i, j] *= amplitude[i, j] / magnitude
+                else:
+                    spectrum[i, j] = amplitude[i, j]
+        return error
+
+    def _object_update(object_field, y_start, x_start, probe, weight, updated):
+        """
+        object[roi] += weight * (M * updated - object[roi] * probe), in place; the
+        exit wave is recomputed instead of being kept in a buffer.
+        """
+        height, width = probe.shape
+        for i in nb.prange(height):
+            for j in range(width):
+                sign = 1 - 2 * ((i + j) & 1)
+                current = object_field[y_start + i, x_start + j]
+                residual = sign * updated[i, j] - current * probe[i, j]
+                object_field[y_start + i, x_start + j] = (
+                    current + weight[i, j] * residual
+                )
+
+    # (exit wave, modulus constraint, object update) kernels of each variant
+    _KERNELS = {
+        parallel: tuple(
+            _compile(kernel, parallel)
+            for kernel in (_exit_wave, _modulus_constraint, _object_update)
+        )
+        for parallel in (True, False)
+    }
+
+
+class FusedUpdate:
+    """
+    PIE position update with compiled kernels: the exit wave (with the input mask
+    of the centered FFT), the modulus constraint and the object update are each a
+    single pass over preallocated buffers, and the FFTs run in place, so the hot
+    loop allocates nothing. Only even-sized frames and a fixed probe are supported.
+    """
+
+    def __init__(self, probe_shape, dtype, parallel=True):
+        """
+        :param probe_shape: Shape (height, width) of the probe field (even sizes).
+        :param dtype: Complex dtype of the object and probe.
+        :param parallel: Run the kernels on numba's thread pool; False runs them
+            single-threaded, e.g. in the threads of a pool.
+        """
+        if nb is None:
+            raise ImportError("numba is required for the fused kernels")
+        if probe_shape[0] % 2 or probe_shape[1] % 2:
+            raise ValueError(
+                f"Fused kernels need an even probe shape, got {probe_shape}"
+            )
+
+        self.buffer = np.empty(probe_shape, dtype=dtype)
+        self.exit_wave, self.modulus_constraint, self.object_update = _KERNELS[parallel]
+
+    def __call__(self, object_field, probe, object_weight, amplitude, starts):
+        """
+        Apply the PIE update of a position (in place), like _update_position.
+        :param object_field: Complex object field.
+        :param probe: Probe field.
+        :param object_weight: Object feedback weight computed from the probe.
+        :param amplitude: Measured amplitude of the position.
+        :param starts: ROI origin (y_start, x_start).
+        :return: Fourier magnitude error of the position.
+        """
+        backend = get_fft_backend()
+        y_start, x_start = starts
+
+        self.exit_wave(object_field, y_start, x_start, probe, self.buffer)
+        backend.fft2(self.buffer, out=self.buffer)
+        error = self.modulus_constraint(self.buffer, amplitude)
+        backend.ifft2(self.buffer, out=self.buffer)
+        self.object_update(
+            object_field, y_start, x_start, probe, object_weight, self.buffer
+        )
+
+        return error
@@ -0,0 +1,121 @@
+import hashlib
+import json
+import os
+
+import cv2
+import numpy as np
+
+# Size of the blocks read while hashing the source images
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def prepare_amplitudes(diffraction_patterns, frame_shape=None, n_frames=None):
+    """
+    Convert measured intensities into a contiguous float32 amplitude stack.
+    :param diffraction_patterns: List, stack or iterable (e.g. a streamed load_data)
+        of measured diffraction patterns.
+    :param frame_shape: Shape (height, width) the amplitudes are resized to,
+        the shape of the first pattern if None.
+    :param n_frames: Number of patterns, required if diffraction_patterns has no len().
+    :return: Amplitude stack of shape (N, height, width).
+    """
+    if n_frames is None:
+        n_frames = len(diffraction_patterns)
+
+    amplitudes = None
+    for i, pattern in enumerate(diffraction_patterns):
+        if amplitudes is None:
+            height, width = pattern.shape if frame_shape is None else frame_shape
+            amplitudes = np.empty((n_frames, height, width), np.float32)
+
+        amplitude = np.sqrt(pattern, dtype=np.float32)
+        if amplitude.shape != (height, width):
+            amplitude = cv2.resize(amplitude, (width, height))
+        amplitudes[i] = amplitude
+
+    return amplitudes
+
+
+def dataset_key(image_paths, settings):
+    """
+    Hash the content of the source images together with the preprocessing settings.
+    The images are read as raw bytes, without decoding them.
+    :param image_paths: Paths of the source images, in stack order.
+    :param settings: JSON-serializable preprocessing settings.
+    :return: Hexadecimal digest identifying the preprocessed stack.
+    """
+    digest = hashlib.sha256(json.dumps(settings, sort_keys=True).encode())
+
+    for image_path in image_paths:
+        digest.update(os.path.basename(image_path).encode())
+        with open(image_path, "rb") as file:
+            for block in iter(lambda: file.read(HASH_BLOCK_SIZE), b""):
+                digest.update(block)
+
+    return digest.hexdigest()
+
+
+def cache_path(cache_dir, key):
+    """
+    Path of the cached amplitude stack of a dataset.
+    """
+    return os.path.join(cache_dir, f"amplitudes_{key}.npy")
+
+
+def load_cached_amplitudes(cache_dir, key):
+    """
+    Load a cached amplitude stack.
+    :return: Amplitude stack, or None if the dataset has not been cached yet.
+    """
+    path = cache_path(cache_dir, key)
+    if not os.path.exists(path):
+        return None
+    return np.load(path)
+
+
+def save_cached_amplitudes(cache_dir, key, amplitudes):
+    """
+    Save an amplitude stack to the cache (atomically, so readers never see partial files).
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    path = cache_path(cache_dir, key)
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+
+    with open(temporary_path, "wb") as file:
+        np.save(file, np.ascontiguousarray(amplitudes, dtype=np.float32))
+    os.replace(temporary_path, path)
+
+
+def crop_amplitudes(measured_amplitudes, factor, chunk_frames=64):
+    """
+    Keep the central 1/factor of every diffraction pattern (its low frequencies).
+    The cropped patterns describe the object at factor times the pixel size, and
+    are scaled by 1/factor^2 so the coarse object keeps the magnitude of the
+    native one.
+    :param measured_amplitudes: Amplitude stack (array or DiffractionStack).
+    :param factor: Integer crop factor, dividing the frame height and width.
+    :param chunk_frames: Number of frames read together from the stack.
+    :return: Cropped amplitude stack (N, height / factor, width / factor).
+    """
+    height, width = measured_amplitudes.shape[1:]
+    if height % factor or width % factor:
+        raise ValueError(
+            f"Crop factor {factor} does not divide the frame shape {(height, width)}"
+        )
+    if factor == 1:
+        return measured_amplitudes
+
+    # The zero frequency is at (height // 2, width // 2) in the centered patterns
+    crop_height, crop_width = height // factor, width // factor
+    rows = slice(
+        height // 2 - crop_height // 2, height // 2 - crop_height // 2 + crop_height
+    )
+    cols = slice(
+        width // 2 - crop_width // 2, width // 2 - crop_width // 2 + crop_width
+    )
+
+    cropped = np.empty((len(measured_amplitudes), crop_height, crop_width), np.float32)
+    for first in range(0, len(measured_amplitudes), chunk_frames):
+        chunk = measured_amplitudes[first : first + chunk_frames]
+        cropped[first : first + len(chunk)] = chunk[:, rows, cols] / factor**2
+    return cropped
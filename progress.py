@@ -0,0 +1,104 @@
+import os
+import queue
+import threading
+from collections import namedtuple
+
+import numpy as np
+
+# Progress report of a reconstruction iteration; magnitude and phase are
+# downsampled snapshots of the object, None on iterations without a snapshot
+Progress = namedtuple("Progress", ["iteration", "error", "magnitude", "phase"])
+
+
+def make_progress(iteration, error, object_field=None, downsample=1):
+    """
+    Build the progress report of an iteration, with an optional object snapshot.
+    :param iteration: Iteration number (starting from 0).
+    :param error: Normalized Fourier magnitude error of the iteration.
+    :param object_field: Complex object field to snapshot, None for no snapshot.
+    :param downsample: Keep one pixel every downsample pixels along each axis.
+    :return: Progress report.
+    """
+    if object_field is None:
+        return Progress(iteration, error, None, None)
+
+    # copies, so the engine can keep updating the object while they are saved
+    snapshot = object_field[::downsample, ::downsample]
+    return Progress(
+        iteration,
+        error,
+        np.abs(snapshot).astype(np.float32),
+        np.angle(snapshot).astype(np.float32),
+    )
+
+
+class SnapshotWriter:
+    """
+    Progress callback that saves snapshots to disk on a background thread, so
+    the reconstruction never waits for the file system. A failed write is raised
+    by the next call or by close().
+    """
+
+    def __init__(self, directory, max_pending=8):
+        """
+        :param directory: Folder the snapshots are written to.
+        :param max_pending: Snapshots queued before the engine is slowed down.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.errors = []
+        self.error = None
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def __call__(self, progress):
+        """
+        Record the error of an iteration and queue its snapshot, if any.
+        """
+        self._raise_error()
+        self.errors.append(progress.error)
+
+        if progress.magnitude is not None:
+            self.queue.put(progress)
+
+    def _run(self):
+        while True:
+            progress = self.queue.get()
+            if progress is None:
+                break
+            # After a failure the queue is still drained, so the engine never blocks
+            if self.error is not None:
+                continue
+
+            try:
+                np.savez(
+                    os.path.join(
+                        self.directory, f"snapshot_{progress.iteration:05d}.npz"
+                    ),
+                    iteration=progress.iteration,
+                    error=progress.error,
+                    magnitude=progress.magnitude,
+                    phase=progress.phase,
+                )
+            except Exception as error:
+                self.error = error
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        """
+        Wait for the pending snapshots to be written and stop the writer thread.
+        """
+        self.queue.put(None)
+        self.thread.join()
+        self._raise_error()
+        np.save(os.path.join(self.directory, "errors.npy"), np.array(self.errors))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -3,6 +3,8 @@ import smaract.ctl as ctl  # type: ignore
 from PySide6.QtCore import QThread, Signal, Slot
 from scipy.spatial.distance import cdist  # type: ignore
 
+from trajectory import fermat_spiral
+
 CHANNEL_X = 1
 CHANNEL_Y = 2
 CHANNEL_Z = 0
@@ -30,6 +32,10 @@ class Ptychography(QThread):
         self.stop = False
         self.delay = 0
 
+        # optional online reconstruction (e.g. engines.OnlineReconstruction)
+        # receiving every written frame with its coordinate
+        self.reconstruction = None
+
     def fermat_spiral(
         self,
         n_points: int = 119,
@@ -54,26 +60,8 @@ class Ptychography(QThread):
         np.ndarray
             Array of the cartesian coordinates of the points in the Vogel's spiral
         """
-        # initialize fermat spiral's polar parameters
-        # by dividing n_index by n_points the graph becomes normalized,
-        # then multiplying by the radius gives the desired size
-        n_index: np.ndarray = np.arange(0, n_points)
-        r: np.float64 = radius * np.sqrt(n_index / n_points)
-        golden_angle: np.float64 = np.pi * (3 - np.sqrt(5))
-        theta: np.ndarray = golden_angle * n_index
-
-        # convert to cartesian coordinates
-        x: np.float64 = r * np.cos(theta) + center_x
-        y: np.float64 = r * np.sin(theta) + center_y
-
-        # shift image to (0, 0) => no negative coordinate points
-        if shift:
-            x -= np.min(x)
-            y -= np.min(y)
-
-        coordinates: np.ndarray = np.column_stack((x, y))
-
-        return coordinates
+        # the scan geometry lives in trajectory.py, importable without the hardware stack
+        return fermat_spiral(n_points, radius, center_x, center_y, shift)
 
     def order_by_distance(
         self, point: np.ndarray, coordinates: np.ndarray
@@ -325,6 +313,17 @@ class Ptychography(QThread):
                 while not self.written:
                     QThread.msleep(1)
 
+                # hand the averaged frame over, it is decoded on the reconstruction thread;
+                # a failing reconstruction is dropped so that the scan carries on
+                if self.reconstruction is not None:
+                    try:
+                        self.reconstruction.add_image(
+                            self.camera.last_image_path, coordinate
+                        )
+                    except Exception as error:
+                        print(f"Online reconstruction disabled: {error!r}")
+                        self.reconstruction = None
+
                 # TODO: check if stopping is really needed. Perhaps, the release can be done just at the end
                 # release holding position for x-y stages
                 """ t_handle = ctl.OpenCommandGroup(
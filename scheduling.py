@@ -0,0 +1,54 @@
+import numpy as np
+
+
+def overlap_graph(starts, probe_shape):
+    """
+    Build the overlap graph of the probe footprints.
+    Two positions are adjacent when their probe-sized ROIs share at least one pixel.
+    :param starts: Integer ROI origins (N, 2) as (y_start, x_start).
+    :param probe_shape: Shape (height, width) of the probe field.
+    :return: List of neighbour index arrays, one per position.
+    """
+    starts = np.asarray(starts)
+    height, width = probe_shape
+
+    # Sweep the positions sorted by row: only the next ones less than a probe
+    # height below can overlap
+    order = np.argsort(starts[:, 0], kind="stable")
+    rows = starts[order, 0]
+    neighbours = [[] for _ in range(len(starts))]
+
+    for rank, i in enumerate(order):
+        last = np.searchsorted(rows, rows[rank] + height, side="left")
+        candidates = order[rank + 1 : last]
+        overlapping = candidates[np.abs(starts[candidates, 1] - starts[i, 1]) < width]
+        for j in overlapping.tolist():
+            neighbours[i].append(j)
+            neighbours[j].append(i)
+
+    return [np.array(sorted(adjacent), dtype=np.int64) for adjacent in neighbours]
+
+
+def colour_positions(starts, probe_shape):
+    """
+    Greedily colour the overlap graph into independent sets of positions.
+    The positions of a set have disjoint footprints, so their PIE updates commute
+    and can run concurrently; running the sets one after the other keeps the
+    sequential semantics.
+    :param starts: Integer ROI origins (N, 2) as (y_start, x_start).
+    :param probe_shape: Shape (height, width) of the probe field.
+    :return: List of index arrays, one per colour, each in scan order.
+    """
+    neighbours = overlap_graph(starts, probe_shape)
+    colours = np.full(len(neighbours), -1, dtype=np.int64)
+
+    # Most constrained positions first (largest degree), ties in scan order
+    degrees = np.array([len(adjacent) for adjacent in neighbours])
+    for i in np.argsort(-degrees, kind="stable").tolist():
+        taken = set(colours[neighbours[i]].tolist())
+        colour = 0
+        while colour in taken:
+            colour += 1
+        colours[i] = colour
+
+    return [np.flatnonzero(colours == colour) for colour in range(colours.max() + 1)]
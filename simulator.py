@@ -0,0 +1,163 @@
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from fft_backend import fft2c
+from subpixel import split_positions
+
+# Largest count of the 16-bit frames written by the camera
+MAX_COUNT = 65535
+
+
+def intensity_scale(probe, photons=None, saturation=MAX_COUNT, binning=1):
+    """
+    Counts per unit of |fft2c(exit wave)|^2 of a simulated detector.
+    :param probe: Probe field.
+    :param photons: Photons per frame of the unobstructed probe; None scales the
+        frames so that no object with |object| <= 1 saturates the detector.
+    :param saturation: Count at which the detector pixels saturate.
+    :param binning: Binning factor of the detector.
+    :return: Scale factor of the intensities.
+    """
+    if photons is None:
+        # |object| <= 1 bounds every spectrum by the one of |probe|, peaking at its centre
+        peak = np.max(np.abs(fft2c(np.abs(probe)))) ** 2
+        return saturation / (peak * binning**2)
+    return photons / np.sum(np.abs(fft2c(probe)) ** 2)
+
+
+def bin_frames(frames, binning):
+    """
+    Sum blocks of binning x binning pixels, like the on-chip binning of the camera.
+    :param frames: Stack of frames (N, height, width), both divisible by binning.
+    :param binning: Binning factor.
+    :return: Binned stack (N, height // binning, width // binning).
+    """
+    if binning == 1:
+        return frames
+    n_frames, height, width = frames.shape
+    return frames.reshape(
+        n_frames, height // binning, binning, width // binning, binning
+    ).sum(axis=(2, 4))
+
+
+def simulate_scan(
+    object_field,
+    probe,
+    coordinates,
+    pixel_size,
+    photons=None,
+    saturation=MAX_COUNT,
+    binning=1,
+    chunk_frames=64,
+    seed=None,
+):
+    """
+    Simulate the far-field diffraction frames of a scan, chunk by chunk: the exit
+    waves of a chunk are transformed together with one batched FFT, and only one
+    chunk of frames is in memory at a time.
+    The origin of the object is the first position of the scan (the smallest
+    coordinates), as in the reconstruction engines.
+    :param object_field: Complex object field, covering every probe position.
+    :param probe: Probe field (shape of the unbinned detector).
+    :param coordinates: Array (N, 2) of (x, y) stage coordinates in micrometers,
+        as saved to coordinates.csv by Ptychography.acquisition.
+    :param pixel_size: Size of each pixel in micrometers.
+    :param photons: Mean photons per frame of the unobstructed probe, with Poisson
+        noise; None gives noiseless frames scaled to the detector range.
+    :param saturation: Count at which the detector saturates (frames are clipped).
+    :param binning: Sum blocks of binning x binning detector pixels.
+    :param chunk_frames: Number of frames simulated together.
+    :param seed: Seed of the Poisson noise.
+    :return: Generator of uint16 frame chunks (n, height // binning, width // binning).
+    """
+    height, width = probe.shape
+    if height % binning or width % binning:
+        raise ValueError(
+            f"Binning {binning} does not divide the probe shape {probe.shape}"
+        )
+    if saturation > MAX_COUNT:
+        raise ValueError(f"Saturation {saturation} exceeds the 16-bit range")
+
+    positions_px = np.asarray(coordinates, dtype=np.float64) / pixel_size
+    starts, _ = split_positions(positions_px - np.rint(positions_px.min(axis=0)))
+    if np.any(starts.max(axis=0) + probe.shape > object_field.shape):
+        raise ValueError(
+            f"Object of shape {object_field.shape} does not cover the scan, "
+            f"which needs {tuple(starts.max(axis=0) + probe.shape)}"
+        )
+
+    scale = intensity_scale(probe, photons, saturation, binning)
+    rng = np.random.default_rng(seed)
+
+    for first in range(0, len(starts), chunk_frames):
+        exit_waves = np.stack(
+            [
+                object_field[y : y + height, x : x + width] * probe
+                for y, x in starts[first : first + chunk_frames].tolist()
+            ]
+        )
+        spectra = fft2c(exit_waves, overwrite_input=True)
+        intensities = bin_frames(np.square(np.abs(spectra)) * scale, binning)
+
+        if photons is not None:
+            intensities = rng.poisson(intensities)
+        yield np.clip(np.rint(intensities), 0, saturation).astype(np.uint16)
+
+
+def write_scan(
+    image_folder,
+    positions_file,
+    object_field,
+    probe,
+    coordinates,
+    pixel_size,
+    first_index=1,
+    workers=None,
+    **simulation_options,
+):
+    """
+    Simulate a scan and write it in the layout read by load_data: one 16-bit
+    image_{i}.png per position and the coordinates as coordinates.csv. The PNGs
+    are encoded on a thread pool (cv2.imwrite releases the GIL) while the next
+    chunk is simulated.
+    :param image_folder: Folder of the images, created if needed.
+    :param positions_file: Path of the CSV file of the coordinates.
+    :param object_field: Complex object field (see simulate_scan).
+    :param probe: Probe field.
+    :param coordinates: Array (N, 2) of (x, y) stage coordinates in micrometers.
+    :param pixel_size: Size of each pixel in micrometers.
+    :param first_index: Index of the first image, as numbered by the camera.
+    :param workers: Number of encoding threads, all available cores if None.
+    :param simulation_options: Further arguments of simulate_scan.
+    :return: Image indices, to pass to load_data.
+    """
+    os.makedirs(image_folder, exist_ok=True)
+    np.savetxt(positions_file, coordinates, delimiter=",")
+
+    workers = workers or os.cpu_count() or 1
+    index = first_index
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for frames in simulate_scan(
+            object_field, probe, coordinates, pixel_size, **simulation_options
+        ):
+            for frame in frames:
+                pending.append(
+                    executor.submit(
+                        cv2.imwrite, f"{image_folder}/image_{index}.png", frame
+                    )
+                )
+                index += 1
+            # at most two chunks of frames wait to be encoded
+            while len(pending) > 2 * len(frames):
+                if not pending.popleft().result():
+                    raise OSError(f"Unable to write the images to {image_folder}")
+        while pending:
+            if not pending.popleft().result():
+                raise OSError(f"Unable to write the images to {image_folder}")
+
+    return range(first_index, index)
@@ -0,0 +1,107 @@
+import numpy as np
+
+from fft_backend import fft2c, ifft2c
+
+# How the shifted probes are kept between iterations
+SHIFT_CACHES = ("kernels", "ramps")
+
+
+def split_positions(positions_px):
+    """
+    Split probe positions into integer pixel origins and sub-pixel remainders.
+    :param positions_px: Array of probe positions (x, y) in pixels.
+    :return: Integer origins (N, 2) and fractional shifts (N, 2) in [-0.5, 0.5],
+        both as (y, x).
+    """
+    positions = np.asarray(positions_px, dtype=np.float64)[:, ::-1]
+    starts = np.rint(positions)
+    return starts.astype(np.int64), positions - starts
+
+
+def fourier_shift_ramps(shape, shifts, dtype=np.complex128):
+    """
+    Separable 1D Fourier phase ramps that translate a centered spectrum.
+    :param shape: Shape (height, width) of the grid.
+    :param shifts: Array (N, 2) of (y, x) shifts in pixels.
+    :param dtype: Complex dtype of the ramps.
+    :return: Row ramps (N, height) and column ramps (N, width).
+    """
+    # Frequencies of the centered (fftshifted) spectrum, in cycles per pixel
+    freq_y = (np.arange(shape[0]) - shape[0] // 2) / shape[0]
+    freq_x = (np.arange(shape[1]) - shape[1] // 2) / shape[1]
+
+    ramps_y = np.exp(-2j * np.pi * np.outer(shifts[:, 0], freq_y))
+    ramps_x = np.exp(-2j * np.pi * np.outer(shifts[:, 1], freq_x))
+    return ramps_y.astype(dtype), ramps_x.astype(dtype)
+
+
+class ShiftedProbes:
+    """
+    Probe translated by the sub-pixel remainder of every scan position.
+    With cache="kernels" every shifted probe is computed once and stored, so the
+    iterations only pay for a multiply; with cache="ramps" only the separable 1D
+    ramps are stored and each shifted probe is rebuilt with one inverse FFT.
+    A weight of the probes (e.g. the object feedback weight) can be kept along
+    with them: cached with the kernels, recomputed per call with the ramps.
+    """
+
+    def __init__(self, probe, shifts, cache="kernels", weight=None):
+        """
+        :param probe: Probe field; its complex dtype sets the precision of the ramps.
+        :param shifts: Array (N, 2) of (y, x) sub-pixel shifts.
+        :param cache: "kernels" or "ramps".
+        :param weight: Function giving a weight from a (stack of) probe(s), read
+            with with_weights; None if unused.
+        """
+        if cache not in SHIFT_CACHES:
+            raise ValueError(
+                f"Unknown shift cache {cache!r}, expected one of {SHIFT_CACHES}"
+            )
+
+        self.cache = cache
+        self.weight = weight
+        self.ramps_y, self.ramps_x = fourier_shift_ramps(
+            probe.shape, shifts, np.result_type(probe.dtype, np.complex64)
+        )
+        self.set_probe(probe)
+
+    def set_probe(self, probe):
+        """
+        Replace the probe and rebuild the cached shifted probes and weights.
+        """
+        self.spectrum = fft2c(probe)
+        self.kernels = self._shift(slice(None)) if self.cache == "kernels" else None
+        self.weights = (
+            None
+            if self.kernels is None or self.weight is None
+            else self.weight(self.kernels)
+        )
+
+    def _shift(self, index):
+        """
+        Translate the probe spectrum with the ramps of the given position(s).
+        """
+        spectrum = (
+            self.spectrum * self.ramps_y[index, :, None] * self.ramps_x[index, None, :]
+        )
+        return ifft2c(spectrum, overwrite_input=True)
+
+    def __len__(self):
+        return len(self.ramps_y)
+
+    def __getitem__(self, index):
+        """
+        Shifted probe of a position (int) or stack of shifted probes (slice or array).
+        """
+        if self.kernels is not None:
+            return self.kernels[index]
+        return self._shift(index)
+
+    def with_weights(self, index):
+        """
+        Shifted probe(s) of a position or positions (see __getitem__) and their weights.
+        """
+        if self.weights is not None:
+            return self.kernels[index], self.weights[index]
+        probes = self[index]
+        return probes, self.weight(probes)
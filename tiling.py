@@ -0,0 +1,100 @@
+from collections import namedtuple
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# Spatial tile of the object canvas: the indices of the positions it owns and
+# its extent (y_start, y_stop, x_start, x_stop) on the canvas, the bounding box
+# of their ROIs; extents of neighbouring tiles overlap along the tile borders
+Tile = namedtuple("Tile", ["positions", "extent"])
+
+
+def partition_tiles(starts, probe_shape, canvas_shape, tiles):
+    """
+    Split the object canvas into a grid of tiles and assign every position to the
+    tile containing the centre of its ROI.
+    The partition only depends on the positions and shapes, so the same tiles can
+    be handed to local processes or to remote workers.
+    :param starts: Integer ROI origins (N, 2) as (y_start, x_start) on the canvas.
+    :param probe_shape: Shape (height, width) of the probe field.
+    :param canvas_shape: Shape of the object canvas.
+    :param tiles: Number of tiles (rows, columns).
+    :return: List of Tile, without the tiles that own no position.
+    """
+    starts = np.asarray(starts)
+    height, width = probe_shape
+    centres = starts + np.array(probe_shape) // 2
+
+    # Index of the tile row/column of every position
+    cells = []
+    for axis, (size, count) in enumerate(zip(canvas_shape, tiles)):
+        edges = np.linspace(0, size, count + 1)
+        cells.append(
+            np.clip(np.searchsorted(edges, centres[:, axis], "right") - 1, 0, count - 1)
+        )
+
+    partition = []
+    for row in range(tiles[0]):
+        for col in range(tiles[1]):
+            positions = np.flatnonzero((cells[0] == row) & (cells[1] == col))
+            if len(positions) == 0:
+                continue
+            origins = starts[positions]
+            extent = (
+                int(origins[:, 0].min()),
+                int(origins[:, 0].max()) + height,
+                int(origins[:, 1].min()),
+                int(origins[:, 1].max()) + width,
+            )
+            partition.append(Tile(positions, extent))
+
+    return partition
+
+
+def tile_slices(extent):
+    """
+    Canvas slices (rows, columns) of a tile extent.
+    """
+    y_start, y_stop, x_start, x_stop = extent
+    return slice(y_start, y_stop), slice(x_start, x_stop)
+
+
+class SharedArray:
+    """
+    Numpy array backed by a multiprocessing.shared_memory block, so worker
+    processes attach to it by name instead of receiving copies.
+    """
+
+    def __init__(self, shape, dtype, name=None):
+        """
+        :param shape: Shape of the array.
+        :param dtype: Dtype of the array.
+        :param name: Name of an existing block to attach to; None creates a new one.
+        """
+        self.shape, self.dtype = tuple(shape), np.dtype(dtype)
+        if name is None:
+            size = max(1, int(np.prod(self.shape)) * self.dtype.itemsize)
+            self.memory = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.memory.buf)
+
+    def spec(self):
+        """
+        Picklable (shape, dtype, name) to attach to the block from another process.
+        """
+        return self.shape, self.dtype.str, self.memory.name
+
+    def close(self):
+        """
+        Detach from the block (the array can no longer be used).
+        """
+        del self.array
+        self.memory.close()
+
+    def unlink(self):
+        """
+        Detach from the block and free it; only the creating process should call this.
+        """
+        self.close()
+        self.memory.unlink()
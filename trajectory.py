@@ -0,0 +1,50 @@
+import numpy as np
+
+
+def fermat_spiral(
+    n_points: int = 119,
+    radius: float = 10.0,
+    center_x: float = 0.0,
+    center_y: float = 0.0,
+    shift: bool = False,
+) -> np.ndarray:
+    """fermat_spiral summary
+
+    Parameters
+    ----------
+    n_points : int, optional
+        Number of points in the Vogel's spiral, by default 119
+    radius : float, optional
+        Radius of the spiral and scaling factor of distance between points, by default 10.0
+    center_x : float, optional
+        X coordinate of the center of the spiral, by default 0.0
+    center_y : float, optional
+        Y coordinate of the center of the spiral, by default 0.0
+    shift : bool, optional
+        Translate all points to the first quadrant, by default False
+
+    Returns
+    -------
+    np.ndarray
+        Array of the cartesian coordinates of the points in the Vogel's spiral
+    """
+    # initialize fermat spiral's polar parameters
+    # by dividing n_index by n_points the graph becomes normalized,
+    # then multiplying by the radius gives the desired size
+    n_index: np.ndarray = np.arange(0, n_points)
+    r: np.float64 = radius * np.sqrt(n_index / n_points)
+    golden_angle: np.float64 = np.pi * (3 - np.sqrt(5))
+    theta: np.ndarray = golden_angle * n_index
+
+    # convert to cartesian coordinates
+    x: np.float64 = r * np.cos(theta) + center_x
+    y: np.float64 = r * np.sin(theta) + center_y
+
+    # shift image to (0, 0) => no negative coordinate points
+    if shift:
+        x -= np.min(x)
+        y -= np.min(y)
+
+    coordinates: np.ndarray = np.column_stack((x, y))
+
+    return coordinates